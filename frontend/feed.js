@@ -97,6 +97,20 @@ $(function(){
         twttr.widgets.load($('#fold').get(0));
     }
 
+    function replaceEntries(entries) {
+        $.each(entries, function(ii, entry) {
+            var $elements = $(entry);
+            var entryId = $elements.filter('article').last().attr('data-entry');
+            var $old = $('article[data-entry="' + entryId + '"]');
+            if ($old.length) {
+                $old.first().before($elements);
+                $old.remove();
+                twttr.widgets.load($elements.get(0));
+            }
+        });
+        attachListeners();
+    }
+
     // topic will be user:id or feed:id
     function webSocketSubscribe(topic) {
         if ('WebSocket' in window) {
@@ -112,7 +126,11 @@ $(function(){
             };
             ws.onmessage = function(event) {
                 var data = JSON.parse(event.data);
-                foldNewEntries(data.entries);
+                if (data.updated) {
+                    replaceEntries(data.entries);
+                } else {
+                    foldNewEntries(data.entries);
+                }
             };
         }
     }
@@ -0,0 +1,38 @@
+from config import Config
+import sqlalchemy
+import sqlalchemy.orm
+from woodwind.models import Entry
+from woodwind import tasks
+
+engine = sqlalchemy.create_engine(Config.SQLALCHEMY_DATABASE_URI)
+Session = sqlalchemy.orm.sessionmaker(bind=engine)
+
+try:
+    engine.execute('alter table entry add column content_hash varchar(40)')
+except:
+    pass
+
+BATCH_SIZE = 1000
+
+session = Session()
+try:
+    last_id = 0
+    while True:
+        batch = session.query(Entry)\
+                       .filter(Entry.id > last_id,
+                               Entry.content_hash == None)\
+                       .order_by(Entry.id)\
+                       .limit(BATCH_SIZE)\
+                       .all()
+        if not batch:
+            break
+        for entry in batch:
+            entry.content_hash = tasks.content_fingerprint(entry)
+        last_id = batch[-1].id
+        print('processed through', last_id)
+        session.commit()
+except:
+    session.rollback()
+    raise
+finally:
+    session.close()
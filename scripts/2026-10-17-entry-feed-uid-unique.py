@@ -0,0 +1,22 @@
+from config import Config
+import sqlalchemy
+
+# CREATE INDEX CONCURRENTLY can't run inside a transaction
+engine = sqlalchemy.create_engine(Config.SQLALCHEMY_DATABASE_URI,
+                                  isolation_level='AUTOCOMMIT')
+
+# keep the newest copy of any uid a feed has stored more than once, and
+# detach the rest the same way update_feed detaches replaced entries
+engine.execute('''
+UPDATE entry SET feed_id = NULL
+FROM (
+  SELECT
+    id,
+    ROW_NUMBER() OVER (PARTITION BY feed_id, uid ORDER BY id DESC) AS row
+  FROM entry
+  WHERE feed_id IS NOT NULL
+) AS numbered
+WHERE entry.id = numbered.id AND numbered.row > 1
+''')
+engine.execute('create unique index concurrently ix_entry_feed_id_uid '
+               'on entry (feed_id, uid)')
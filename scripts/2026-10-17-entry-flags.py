@@ -0,0 +1,43 @@
+from config import Config
+import sqlalchemy
+
+# CREATE INDEX CONCURRENTLY can't run inside a transaction, and each
+# batch of the backfill commits on its own
+engine = sqlalchemy.create_engine(Config.SQLALCHEMY_DATABASE_URI,
+                                  isolation_level='AUTOCOMMIT')
+
+for column in ('is_jam', 'is_event', 'is_reply', 'is_like', 'is_repost'):
+    try:
+        engine.execute('alter table entry add column {} boolean'
+                       .format(column))
+    except:
+        pass
+
+BATCH_SIZE = 10000
+
+# the same flags Entry.update_flags sets, computed from properties
+NON_EMPTY = ("CASE WHEN json_typeof(properties->'{0}') = 'array' "
+             "THEN json_array_length(properties->'{0}') > 0 ELSE false END")
+
+UPDATE_SQL = '''
+UPDATE entry SET
+  is_jam = coalesce(properties->>'jam' = 'true', false),
+  is_event = coalesce(properties->>'event' = 'true', false),
+  is_reply = {},
+  is_like = {},
+  is_repost = {}
+WHERE id >= %s AND id < %s
+'''.format(NON_EMPTY.format('in-reply-to'), NON_EMPTY.format('like-of'),
+           NON_EMPTY.format('repost-of'))
+
+max_id = engine.execute('SELECT max(id) FROM entry').scalar() or 0
+for start in range(0, max_id + 1, BATCH_SIZE):
+    engine.execute(UPDATE_SQL, (start, start + BATCH_SIZE))
+    print('processed through', start + BATCH_SIZE)
+
+engine.execute('create index concurrently '
+               'ix_entry_jam_retrieved_published_id '
+               'on entry (retrieved, published, id) where is_jam')
+engine.execute('create index concurrently '
+               'ix_entry_event_retrieved_published_id '
+               'on entry (retrieved, published, id) where is_event')
@@ -0,0 +1,28 @@
+from woodwind import create_app, search
+from woodwind.extensions import db
+from woodwind.models import Entry
+
+app = create_app()
+
+BATCH_SIZE = 5000
+
+with app.app_context():
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction, and each
+    # batch of the backfill commits on its own
+    engine = db.engine.execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        engine.execute('alter table entry add column search_vector tsvector')
+    except:
+        pass
+
+    max_id = db.session.query(db.func.max(Entry.id)).scalar() or 0
+    for start in range(0, max_id + 1, BATCH_SIZE):
+        engine.execute(Entry.__table__.update()
+                       .where(Entry.id >= start)
+                       .where(Entry.id < start + BATCH_SIZE)
+                       .where(Entry.feed_id != None)
+                       .values(search_vector=search.document()))
+        print('indexed through', start + BATCH_SIZE)
+
+    engine.execute('create index concurrently ix_entry_search_vector '
+                   'on entry using gin (search_vector)')
@@ -0,0 +1,13 @@
+from config import Config
+import sqlalchemy
+
+# CREATE INDEX CONCURRENTLY can't run inside a transaction
+engine = sqlalchemy.create_engine(Config.SQLALCHEMY_DATABASE_URI,
+                                  isolation_level='AUTOCOMMIT')
+
+engine.execute('create index concurrently ix_entry_retrieved_published_id '
+               'on entry (retrieved, published, id)')
+engine.execute('create index concurrently '
+               'ix_entry_feed_id_retrieved_published_id '
+               'on entry (feed_id, retrieved, published, id)')
+engine.execute('drop index concurrently if exists ix_entry_retrieved')
@@ -0,0 +1,5 @@
+from config import Config
+import sqlalchemy
+
+engine = sqlalchemy.create_engine(Config.SQLALCHEMY_DATABASE_URI)
+engine.execute('alter table feed add column content_hash varchar(40)')
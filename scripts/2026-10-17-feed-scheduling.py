@@ -0,0 +1,24 @@
+from woodwind import create_app, tasks
+from woodwind.extensions import db
+from woodwind.models import Feed
+
+app = create_app()
+
+with app.app_context():
+    for sql in ('alter table feed add column next_check_at timestamp',
+                'create index ix_feed_next_check_at on feed (next_check_at)',
+                'alter table feed add column post_interval integer'):
+        try:
+            db.engine.execute(sql)
+        except:
+            pass
+
+    try:
+        for feed in Feed.query.all():
+            print('scheduling', feed.id)
+            feed.post_interval = tasks.learn_post_interval(feed)
+            tasks.schedule_next_check(feed)
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
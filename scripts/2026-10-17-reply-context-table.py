@@ -0,0 +1,66 @@
+from woodwind import create_app
+from woodwind.extensions import db
+from woodwind.models import ReplyContext, entry_to_context
+
+app = create_app()
+
+BATCH_SIZE = 1000
+
+with app.app_context():
+    # creates reply_context and entry_to_context
+    db.create_all()
+
+    try:
+        # one context per normalized permalink, filled in from the most
+        # recently retrieved of the Entry rows that used to store it
+        contexts = {}
+        links = set()
+        old_ids = set()
+        for row in db.engine.execute('''
+        SELECT link.entry_id, context.id, context.feed_id, context.permalink,
+          context.published, context.retrieved, context.author_name,
+          context.author_url, context.author_photo, context.title,
+          context.content, context.content_cleaned
+        FROM entry_to_reply_context AS link
+        JOIN entry AS context ON context.id = link.context_id
+        WHERE context.permalink IS NOT NULL
+        ORDER BY context.retrieved
+        '''):
+            url = ReplyContext.normalize_permalink(row.permalink)
+            context = contexts.get(url)
+            if not context:
+                context = contexts[url] = ReplyContext(
+                    normalized_permalink=url)
+                db.session.add(context)
+            for attr in ('permalink', 'published', 'author_name',
+                         'author_url', 'author_photo', 'title', 'content',
+                         'content_cleaned'):
+                setattr(context, attr, getattr(row, attr))
+            context.fetched = row.retrieved
+            links.add((row.entry_id, url))
+            if row.feed_id is None:
+                old_ids.add(row.id)
+
+        # a detached entry can have been a context and a reply itself;
+        # it keeps its new links, and is left for prune_entries
+        old_ids -= {entry_id for entry_id, _ in links}
+
+        print('storing', len(contexts), 'contexts for', len(links), 'links')
+        db.session.flush()
+        links = [{'entry_id': entry_id, 'context_id': contexts[url].id}
+                 for entry_id, url in links]
+        for start in range(0, len(links), BATCH_SIZE):
+            db.session.execute(entry_to_context.insert(),
+                               links[start:start + BATCH_SIZE])
+
+        db.session.execute('DROP TABLE entry_to_reply_context')
+        old_ids = list(old_ids)
+        for start in range(0, len(old_ids), BATCH_SIZE):
+            print('deleting old context entries', start, len(old_ids))
+            db.session.execute(
+                'DELETE FROM entry WHERE id = ANY(:ids) AND feed_id IS NULL',
+                {'ids': old_ids[start:start + BATCH_SIZE]})
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
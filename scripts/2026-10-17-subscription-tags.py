@@ -0,0 +1,18 @@
+from woodwind import create_app
+from woodwind.extensions import db
+from woodwind.models import Subscription
+
+app = create_app()
+
+with app.app_context():
+    # creates subscription_tag
+    db.create_all()
+
+    try:
+        for subsc in Subscription.query.filter(Subscription.tags != None):
+            print('tagging', subsc.id, subsc.tags)
+            subsc.set_tags(subsc.tags.split())
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
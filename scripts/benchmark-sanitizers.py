@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""Compare the speed of the content sanitizers in woodwind.util, and how
+often their output differs, on the content of recent entries (or on the
+html files given on the command line).
+
+    python scripts/benchmark-sanitizers.py [--limit 1000] [file.html ...]
+"""
+from woodwind import create_app, util
+from woodwind.models import Entry
+import argparse
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--limit', type=int, default=1000)
+parser.add_argument('--rounds', type=int, default=3)
+parser.add_argument('files', nargs='*')
+args = parser.parse_args()
+
+if args.files:
+    samples = [open(path).read() for path in args.files]
+else:
+    app = create_app()
+    with app.app_context():
+        samples = [content for content, in Entry.query
+                   .with_entities(Entry.content)
+                   .filter(Entry.content != None)
+                   .order_by(Entry.id.desc())
+                   .limit(args.limit)]
+
+total_bytes = sum(len(sample) for sample in samples)
+print('{} samples, {:.1f} KB'.format(len(samples), total_bytes / 1024))
+
+outputs = {}
+for name, sanitize in sorted(util.SANITIZERS.items()):
+    best = None
+    for _ in range(args.rounds):
+        start = time.perf_counter()
+        results = [sanitize(sample) for sample in samples]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    outputs[name] = results
+    print('{:>10}: {:8.3f}s  {:8.1f} samples/s  {:8.1f} KB/s'.format(
+        name, best, len(samples) / best, total_bytes / 1024 / best))
+
+names = sorted(outputs)
+for other in names[1:]:
+    differ = sum(1 for a, b in zip(outputs[names[0]], outputs[other])
+                 if a != b)
+    print('{} and {} differ on {} of {} samples'.format(
+        names[0], other, differ, len(samples)))
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+"""Print the counters of the caches shared through redis, with the hit
+rate of each.
+"""
+from woodwind import cache, create_app, mf2cache
+
+app = create_app()
+
+
+def report(name, stats, hit_keys):
+    lookups = sum(stats.get(k, 0) for k in hit_keys + ('misses',))
+    hits = sum(stats.get(k, 0) for k in hit_keys)
+    print(name)
+    for key, value in sorted(stats.items()):
+        print('{:>12}  {}'.format(value, key))
+    if lookups:
+        print('{:>11.1%}  hit rate'.format(hits / lookups))
+
+
+with app.app_context():
+    report('responses', cache.response_stats(), ('hits',))
+    # this process's own in-memory cache is empty, so leave it out
+    mf2_stats = mf2cache.stats()
+    del mf2_stats['local']
+    report('mf2', mf2_stats, ('hits', 'revalidated'))
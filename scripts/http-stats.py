@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+"""Print the number of outbound requests in flight to each host, the
+busiest first.
+"""
+from woodwind import create_app, http_client
+
+app = create_app()
+
+with app.app_context():
+    stats = http_client.host_stats()
+    for host, counts in sorted(
+            stats.items(),
+            key=lambda item: (item[1]['in_flight'], item[1]['requests']),
+            reverse=True):
+        print('{:>6} {:>10}  {}'.format(
+            counts['in_flight'], counts['requests'], host))
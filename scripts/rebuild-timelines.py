@@ -0,0 +1,15 @@
+#!/usr/bin/env python
+"""Rebuild the precomputed timelines for every user, or for the user ids
+given on the command line.
+"""
+from woodwind import create_app, timeline
+from woodwind.models import User
+import sys
+
+app = create_app()
+
+with app.app_context():
+    user_ids = [int(arg) for arg in sys.argv[1:]] or [
+        user_id for user_id, in User.query.with_entities(User.id)]
+    for user_id in user_ids:
+        print('rebuilding', user_id, timeline.rebuild(user_id))
@@ -5,3 +5,9 @@ from woodwind import tasks
 @timer(300)
 def tick(signum=None):
     tasks.q.enqueue(tasks.tick)
+
+
+@timer(24 * 60 * 60)
+def prune(signum=None):
+    tasks.q.enqueue_call(func=tasks.prune_entries,
+                         timeout=6 * 60 * 60)
@@ -1,7 +1,6 @@
 import flask
 import flask.ext.login as flask_login
-import requests
-from woodwind import util
+from woodwind import http_client, util
 
 api = flask.Blueprint('api', __name__)
 
@@ -34,7 +33,7 @@ def publish():
         data['in-reply-to'] = target
         data['content'] = content
 
-    resp = requests.post(
+    resp = http_client.post(
         flask_login.current_user.micropub_endpoint, data=data, headers={
             'Authorization': 'Bearer {}'.format(
                 flask_login.current_user.access_token),
@@ -53,11 +52,11 @@ def forward_request():
     if flask.request.method == 'GET':
         args = flask.request.args.copy()
         url = args.pop('_url')
-        result = requests.get(url, params=args)
+        result = http_client.get(url, params=args)
     else:
         data = flask.request.form.copy()
         url = data.pop('_url')
-        result = requests.post(url, data=data)
+        result = http_client.post(url, data=data)
 
     return flask.jsonify({
         'code': result.status_code,
@@ -0,0 +1,197 @@
+"""Caches shared between the web and worker processes, kept in redis.
+"""
+from flask import current_app
+from redis import StrictRedis
+import collections
+import hashlib
+import struct
+import time
+import zlib
+
+redis = StrictRedis()
+
+# bump whenever the binary layout changes; entries written with any
+# other version are treated as misses
+RESPONSE_FORMAT_VERSION = 1
+RESPONSE_FLAG_COMPRESSED = 1
+# the only response headers we need to conditionally GET a url again,
+# replay its body, and discover its PuSH hub
+RESPONSE_HEADERS = ('Etag', 'Last-Modified', 'Content-Type', 'Link')
+RESPONSE_TTL = 24 * 3600
+# default limits on the size of one cached response, and all of them
+RESPONSE_MAX_BODY = 2 * 1024 * 1024
+RESPONSE_MAX_BYTES = 256 * 1024 * 1024
+# bodies smaller than this are not worth compressing
+COMPRESS_MIN = 1024
+
+CachedResponse = collections.namedtuple('CachedResponse', [
+    'url', 'status_code', 'headers', 'content_hash', 'content'])
+
+
+class LRUCache:
+    """A small in-process cache that forgets the least recently used keys
+    once it holds more than maxsize of them, and counts hits and misses.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.items[key] = value
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.items)}
+
+
+def get_response(url):
+    """Look up the last successful response for a url, returning a
+    CachedResponse or None.
+    """
+    data = redis.get('respcache:' + url)
+    cached = data and decode_response(data)
+    pipe = redis.pipeline()
+    if cached:
+        pipe.hincrby('respcache:stats', 'hits', 1)
+        pipe.zadd('respcache:lru', time.time(), url)
+    else:
+        pipe.hincrby('respcache:stats', 'misses', 1)
+    pipe.execute()
+    return cached
+
+
+def set_response(url, resp):
+    """Remember a successful requests.Response, unless its body is too
+    large, then evict the least recently used responses if the cache
+    has grown past its size limit.
+    """
+    max_body = current_app.config.get(
+        'RESPONSE_CACHE_MAX_BODY', RESPONSE_MAX_BODY)
+    if len(resp.content) > max_body:
+        redis.hincrby('respcache:stats', 'too_large', 1)
+        return
+
+    data = encode_response(resp)
+    old_size = redis.hget('respcache:sizes', url)
+
+    pipe = redis.pipeline()
+    pipe.setex('respcache:' + url, RESPONSE_TTL, data)
+    pipe.hset('respcache:sizes', url, len(data))
+    pipe.zadd('respcache:lru', time.time(), url)
+    pipe.incrby('respcache:bytes', len(data) - int(old_size or 0))
+    pipe.execute()
+
+    evict_responses()
+
+
+def delete_response(url):
+    """Forget the response for a url, so that it is next fetched in full
+    rather than conditionally.
+    """
+    size = redis.hget('respcache:sizes', url)
+    pipe = redis.pipeline()
+    pipe.delete('respcache:' + url)
+    pipe.hdel('respcache:sizes', url)
+    pipe.zrem('respcache:lru', url)
+    pipe.decrby('respcache:bytes', int(size or 0))
+    pipe.execute()
+
+
+def evict_responses():
+    max_bytes = current_app.config.get(
+        'RESPONSE_CACHE_MAX_BYTES', RESPONSE_MAX_BYTES)
+    while int(redis.get('respcache:bytes') or 0) > max_bytes:
+        urls = redis.zrange('respcache:lru', 0, 99)
+        if not urls:
+            break
+        sizes = redis.hmget('respcache:sizes', urls)
+        pipe = redis.pipeline()
+        pipe.delete(*[b'respcache:' + url for url in urls])
+        pipe.hdel('respcache:sizes', *urls)
+        pipe.zrem('respcache:lru', *urls)
+        pipe.decrby('respcache:bytes', sum(int(s or 0) for s in sizes))
+        pipe.hincrby('respcache:stats', 'evictions', len(urls))
+        pipe.execute()
+
+
+def response_stats():
+    """Hit, miss, and eviction counters for the response cache.
+    """
+    stats = {k.decode(): int(v) for k, v
+             in redis.hgetall('respcache:stats').items()}
+    stats['bytes'] = int(redis.get('respcache:bytes') or 0)
+    return stats
+
+
+def encode_response(resp):
+    """Pack the parts of a response we need into a versioned binary
+    format: a fixed header followed by length-prefixed fields.
+    """
+    content = resp.content
+    content_hash = hashlib.sha1(content).digest()
+    flags = 0
+    if len(content) >= COMPRESS_MIN:
+        compressed = zlib.compress(content)
+        if len(compressed) < len(content):
+            content = compressed
+            flags |= RESPONSE_FLAG_COMPRESSED
+
+    headers = [(name, resp.headers[name]) for name in RESPONSE_HEADERS
+               if name in resp.headers]
+
+    parts = [struct.pack('>BBHB', RESPONSE_FORMAT_VERSION, flags,
+                         resp.status_code, len(headers)),
+             pack_field(resp.url.encode('utf-8'))]
+    for name, value in headers:
+        parts.append(pack_field(name.encode('utf-8')))
+        parts.append(pack_field(value.encode('utf-8')))
+    parts.append(pack_field(content_hash))
+    parts.append(pack_field(content))
+    return b''.join(parts)
+
+
+def decode_response(data):
+    version, flags, status_code, header_count = struct.unpack_from(
+        '>BBHB', data)
+    if version != RESPONSE_FORMAT_VERSION:
+        return None
+
+    offset = struct.calcsize('>BBHB')
+    url, offset = unpack_field(data, offset)
+    headers = {}
+    for _ in range(header_count):
+        name, offset = unpack_field(data, offset)
+        value, offset = unpack_field(data, offset)
+        headers[name.decode('utf-8')] = value.decode('utf-8')
+    content_hash, offset = unpack_field(data, offset)
+    content, offset = unpack_field(data, offset)
+    if flags & RESPONSE_FLAG_COMPRESSED:
+        content = zlib.decompress(content)
+
+    return CachedResponse(url.decode('utf-8'), status_code, headers,
+                          content_hash, content)
+
+
+def pack_field(value):
+    return struct.pack('>I', len(value)) + value
+
+
+def unpack_field(data, offset):
+    length, = struct.unpack_from('>I', data, offset)
+    offset += 4
+    return data[offset:offset + length], offset + length
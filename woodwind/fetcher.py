@@ -0,0 +1,127 @@
+"""Fetch a batch of urls concurrently with asyncio, so that one worker
+can poll hundreds of feeds at once instead of one at a time.
+"""
+from flask import current_app
+from woodwind import http_client, util
+import aiohttp
+import asyncio
+import requests
+
+# default total number of requests in flight at once
+CONCURRENCY = 100
+# default number of requests in flight to any one host
+PER_HOST = 4
+# seconds to wait for any one response
+TIMEOUT = 30
+
+
+def fetch_all(urls, concurrency=CONCURRENCY, per_host=PER_HOST,
+              timeout=TIMEOUT, max_size=None, max_items=None):
+    """Fetch a dict of key -> url, using the same conditional GET cache as
+    util.requests_get. Bodies are limited to max_size bytes, and to the
+    number of feed items given for each key in the max_items dict.
+    Returns a dict of key -> requests.Response, or the exception that was
+    raised while fetching.
+    """
+    lastresps = {}
+    requests_ = {}
+    for key, url in urls.items():
+        lastresps[key] = util.get_cached_response(url)
+        headers = {'User-Agent': util.USER_AGENT}
+        util.add_conditional_headers(headers, lastresps[key])
+        reader = max_size and util.BodyReader(
+            url, max_size, (max_items or {}).get(key))
+        requests_[key] = (url, headers, reader)
+
+    loop = asyncio.new_event_loop()
+    try:
+        results = loop.run_until_complete(fetch_requests(
+            requests_, concurrency, per_host, timeout, loop))
+    finally:
+        loop.close()
+
+    for key, result in results.items():
+        if isinstance(result, requests.Response):
+            current_app.logger.debug(
+                'fetching %s got response %s', urls[key], result)
+            results[key] = util.finish_response(
+                urls[key], result, lastresps[key])
+        else:
+            current_app.logger.debug(
+                'fetching %s failed: %r', urls[key], result)
+    return results
+
+
+@asyncio.coroutine
+def fetch_requests(requests_, concurrency, per_host, timeout, loop):
+    limit = asyncio.Semaphore(concurrency, loop=loop)
+    host_limits = {}
+    results = {}
+
+    @asyncio.coroutine
+    def fetch(key, url, headers, reader):
+        host = http_client.get_host(url)
+        host_limit = host_limits.setdefault(
+            host, asyncio.Semaphore(per_host, loop=loop))
+        with (yield from host_limit):
+            with (yield from limit):
+                # share the host's limits with every other process
+                token = yield from acquire_host(host, loop)
+                try:
+                    results[key] = yield from asyncio.wait_for(
+                        fetch_one(session, url, headers, reader),
+                        timeout, loop=loop)
+                except Exception as e:
+                    results[key] = e
+                finally:
+                    if token:
+                        http_client.release(host, token)
+
+    connector = aiohttp.TCPConnector(
+        use_dns_cache=True, limit=concurrency, loop=loop)
+    session = aiohttp.ClientSession(connector=connector, loop=loop)
+    try:
+        yield from asyncio.gather(*[
+            fetch(key, url, headers, reader)
+            for key, (url, headers, reader) in requests_.items()], loop=loop)
+    finally:
+        session.close()
+    return results
+
+
+@asyncio.coroutine
+def acquire_host(host, loop):
+    deadline = loop.time() + http_client.HOST_WAIT
+    while True:
+        token, wait = http_client.try_acquire(host)
+        if token or loop.time() + wait > deadline:
+            return token
+        yield from asyncio.sleep(wait, loop=loop)
+
+
+@asyncio.coroutine
+def fetch_one(session, url, headers, reader=None):
+    resp = yield from session.get(url, headers=headers)
+    try:
+        if reader and resp.status // 100 == 2:
+            while True:
+                chunk = yield from resp.content.read(util.CHUNK_SIZE)
+                if not chunk or reader.feed(chunk):
+                    break
+            content = reader.content
+        else:
+            content = yield from resp.read()
+    finally:
+        resp.close()
+
+    # join repeated headers (e.g. several Links) the way requests does
+    joined = requests.structures.CaseInsensitiveDict()
+    for name, value in resp.headers.items():
+        if name in joined:
+            joined[name] += ', ' + value
+        else:
+            joined[name] = value
+
+    result = util.build_response(str(resp.url), resp.status, joined, content)
+    result.truncated = bool(reader and reader.truncated)
+    return result
@@ -0,0 +1,115 @@
+"""Cache the rendered HTML of entries for page loads. Running content
+through proxy_all and add_preview (and the rest of _entry.jinja2) is most
+of the work of rendering a page, and none of it depends on who is
+looking, so it is done once per version of an entry and kept in redis,
+with a small in-process cache in front. The subscription header, reply
+area and relative times are filled in for each request.
+"""
+from flask import current_app
+from woodwind import cache
+import hashlib
+import json
+
+# default number of rendered entries kept in each process
+FRAGMENT_CACHE_SIZE = 1000
+FRAGMENT_TTL = 24 * 60 * 60
+# stands in for the text of each <time> in a cached fragment
+TIME_SLOT = '<!--woodwind:time-->'
+# bump when the code of the template filters changes what they output
+FRAGMENT_VERSION = 1
+# every setting the template filters read (the image proxies)
+RENDER_SETTINGS = ('IMAGEPROXY_URL', 'IMAGEPROXY_KEY', 'PILBOX_URL',
+                   'PILBOX_KEY', 'CAMO_URL', 'CAMO_KEY')
+
+local_cache = None
+template_version = None
+
+
+def get_local_cache():
+    global local_cache
+    if local_cache is None:
+        local_cache = cache.LRUCache(current_app.config.get(
+            'FRAGMENT_CACHE_SIZE', FRAGMENT_CACHE_SIZE))
+    return local_cache
+
+
+def get_template_version():
+    """A hash of the entry template, so that changing it (and
+    deploying) doesn't serve fragments rendered by the old one.
+    """
+    global template_version
+    if template_version is None:
+        env = current_app.jinja_env
+        source = env.loader.get_source(env, '_entry.jinja2')[0]
+        template_version = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    return template_version
+
+
+def entry_key(entry):
+    """Identifies one rendering of an entry: its content, the versions of
+    its reply contexts, the template and filter code, and the settings
+    the filters read (no per-user settings reach the cached part).
+    """
+    def isoformat(dt):
+        return dt and dt.isoformat()
+
+    parts = [
+        FRAGMENT_VERSION,
+        get_template_version(),
+        [current_app.config.get(name) for name in RENDER_SETTINGS],
+        entry.id,
+        entry.content_hash or isoformat(entry.retrieved),
+        [(c.id, isoformat(c.fetched)) for c in entry.reply_context],
+    ]
+    return 'fragment:' + hashlib.sha1(
+        json.dumps(parts).encode('utf-8')).hexdigest()
+
+
+def get_fragments(keys):
+    """Look up many fragments at once, with one round trip to redis for
+    those not cached in process. Returns a dict of the ones found.
+    """
+    local = get_local_cache()
+    found = {}
+    for key in keys:
+        html = local.get(key)
+        if html is not None:
+            found[key] = html
+
+    missing = [key for key in keys if key not in found]
+    if missing:
+        pipe = cache.redis.pipeline(transaction=False)
+        pipe.mget(missing)
+        for key, html in zip(missing, pipe.execute()[0]):
+            if html is not None:
+                found[key] = html.decode('utf-8')
+                local.set(key, found[key])
+
+        hits = sum(1 for key in missing if key in found)
+        pipe = cache.redis.pipeline(transaction=False)
+        pipe.hincrby('fragmentcache:stats', 'hits', hits)
+        pipe.hincrby('fragmentcache:stats', 'misses', len(missing) - hits)
+        pipe.execute()
+    return found
+
+
+def set_fragments(fragments):
+    """Store a dict of key -> rendered html.
+    """
+    if fragments:
+        local = get_local_cache()
+        pipe = cache.redis.pipeline(transaction=False)
+        for key, html in fragments.items():
+            local.set(key, html)
+            pipe.setex(key, FRAGMENT_TTL, html)
+        pipe.execute()
+
+
+def fill_times(html, times, relative_time):
+    """Fill in the time slots of a cached fragment, in order.
+    """
+    parts = html.split(TIME_SLOT)
+    result = [parts[0]]
+    for part, dt in zip(parts[1:], times):
+        result += [relative_time(dt) or '', part]
+    return ''.join(result)
@@ -0,0 +1,218 @@
+"""The one place outbound HTTP requests are made from. Every process
+shares per-host limits on concurrency and request rate through redis,
+which also records how many requests are in flight to each host, and
+caches DNS lookups for all of them.
+
+Connections are pooled and kept alive per thread, which only pays off
+in long-lived processes: the web processes, and the batch fetches of
+update_feeds. rq forks a fresh work horse for every job, so a worker's
+pool never outlives one job.
+"""
+from contextlib import contextmanager
+from flask import current_app, has_app_context
+from woodwind import cache
+import http.cookiejar
+import requests
+import requests.adapters
+import socket
+import threading
+import time
+import urllib.parse
+import uuid
+
+USER_AGENT = 'Woodwind (https://github.com/kylewm/woodwind)'
+TIMEOUT = (9.1, 30)
+
+# hosts kept in each session's pool, and connections kept per host
+POOL_CONNECTIONS = 100
+POOL_MAXSIZE = 10
+# default number of requests in flight to any one host, across every
+# process, and the fewest seconds between starting two of them
+HOST_CONCURRENCY = 4
+HOST_INTERVAL = 0.2
+# the longest we'll wait for a host to free up before going ahead anyway
+HOST_WAIT = 30
+# a slot whose holder never gave it back (a killed worker, say) is
+# reclaimed after this many seconds
+SLOT_TTL = 120
+# seconds to remember resolved addresses
+DNS_CACHE_TTL = 300
+
+local = threading.local()
+dns_cache = {}
+dns_lock = threading.Lock()
+cached_connection_classes = {}
+
+
+def resolve(host, port):
+    """Look up the address to connect to for a host, remembering it for
+    DNS_CACHE_TTL seconds, in process and in redis (so that it outlives
+    the forked work horse that looked it up).
+    """
+    key = (host, port)
+    now = time.time()
+    with dns_lock:
+        cached = dns_cache.get(key)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    redis_key = 'dns:{}:{}'.format(host, port)
+    address = cache.redis.get(redis_key)
+    if address is not None:
+        address = address.decode()
+        ttl = max(cache.redis.ttl(redis_key) or 0, 0)
+    else:
+        address = socket.getaddrinfo(
+            host, port, 0, socket.SOCK_STREAM)[0][4][0]
+        cache.redis.setex(redis_key, DNS_CACHE_TTL, address)
+        ttl = DNS_CACHE_TTL
+    with dns_lock:
+        dns_cache[key] = (now + ttl, address)
+    return address
+
+
+class CachedDNSMixin:
+    """Connects to the cached address of the host. The host name itself
+    is left in place for everything else (the Host header, SNI and
+    certificate checks), which only look at it after connecting.
+    """
+    def _new_conn(self):
+        host = self.host
+        self.host = resolve(host, self.port)
+        try:
+            return super()._new_conn()
+        finally:
+            self.host = host
+
+
+class PooledAdapter(requests.adapters.HTTPAdapter):
+    """Uses the DNS cache for its own connections, without changing how
+    anything else in the process (redis, say) resolves names.
+    """
+    def get_connection(self, url, proxies=None):
+        pool = super().get_connection(url, proxies)
+        cls = pool.ConnectionCls
+        if not issubclass(cls, CachedDNSMixin):
+            if cls not in cached_connection_classes:
+                cached_connection_classes[cls] = type(
+                    'Cached' + cls.__name__, (CachedDNSMixin, cls), {})
+            pool.ConnectionCls = cached_connection_classes[cls]
+        return pool
+
+
+class RejectCookies(http.cookiejar.DefaultCookiePolicy):
+    def set_ok(self, cookie, request):
+        return False
+
+
+def get_session():
+    """A pooled, keep-alive session for the current thread. It is shared
+    by requests made on behalf of different users, so it never keeps
+    cookies from one request to the next.
+    """
+    session = getattr(local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        session.headers['User-Agent'] = USER_AGENT
+        session.cookies.set_policy(RejectCookies())
+        adapter = PooledAdapter(
+            pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        local.session = session
+    return session
+
+
+def get_host(url):
+    return urllib.parse.urlparse(url).netloc.lower()
+
+
+def get_config(key, default):
+    if has_app_context():
+        return current_app.config.get(key, default)
+    return default
+
+
+def try_acquire(host):
+    """Take one of a host's slots, if it has one free and hasn't been sent
+    a request too recently. Returns (token, 0) on success, and otherwise
+    (None, the number of seconds to wait before trying again).
+    """
+    key = 'http:inflight:' + host
+    token = uuid.uuid4().hex
+    now = time.time()
+
+    pipe = cache.redis.pipeline()
+    pipe.zremrangebyscore(key, 0, now)
+    pipe.zadd(key, now + SLOT_TTL, token)
+    pipe.zcard(key)
+    pipe.expire(key, SLOT_TTL)
+    in_flight = pipe.execute()[2]
+    if in_flight > get_config('HTTP_HOST_CONCURRENCY', HOST_CONCURRENCY):
+        cache.redis.zrem(key, token)
+        return None, 0.1
+
+    interval = get_config('HTTP_HOST_INTERVAL', HOST_INTERVAL)
+    if interval and not cache.redis.set(
+            'http:last:' + host, 1, px=int(interval * 1000), nx=True):
+        cache.redis.zrem(key, token)
+        wait = cache.redis.pttl('http:last:' + host)
+        return None, max(wait, 10) / 1000
+
+    cache.redis.hincrby('http:requests', host, 1)
+    return token, 0
+
+
+def release(host, token):
+    cache.redis.zrem('http:inflight:' + host, token)
+
+
+@contextmanager
+def host_slot(url):
+    """Hold one of the url's host's slots for the duration of the block.
+    """
+    host = get_host(url)
+    deadline = time.time() + HOST_WAIT
+    while True:
+        token, wait = try_acquire(host)
+        if token or time.time() + wait > deadline:
+            break
+        time.sleep(wait)
+
+    if not token:
+        current_app.logger.warn('gave up waiting for a slot on %s', host)
+        cache.redis.hincrby('http:requests', host, 1)
+    try:
+        yield
+    finally:
+        if token:
+            release(host, token)
+
+
+def request(method, url, **kwargs):
+    kwargs.setdefault('timeout', TIMEOUT)
+    with host_slot(url):
+        return get_session().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def host_stats():
+    """The number of requests in flight to each host right now, and made
+    to it in total.
+    """
+    now = time.time()
+    result = {host.decode(): {'in_flight': 0, 'requests': int(count)}
+              for host, count
+              in cache.redis.hgetall('http:requests').items()}
+    for key in cache.redis.scan_iter('http:inflight:*'):
+        host = key.decode()[len('http:inflight:'):]
+        stats = result.setdefault(host, {'in_flight': 0, 'requests': 0})
+        stats['in_flight'] = cache.redis.zcount(key, now, '+inf')
+    return result
@@ -0,0 +1,73 @@
+"""Cache parsed microformats for the pages we look up over and over (the
+targets of in-reply-tos and authors' h-cards), shared by every worker in
+redis, with a small in-process cache in front.
+"""
+from flask import current_app
+from woodwind import cache, util
+import hashlib
+import json
+import mf2py
+import time
+
+# default number of parsed pages kept in each process
+MF2_CACHE_SIZE = 1000
+# a cached parse is used as-is for this many seconds, then revalidated
+MF2_FRESH = 60 * 60
+# and is dropped from redis altogether after this many
+MF2_TTL = 7 * 24 * 60 * 60
+
+local_cache = None
+
+
+def get_local_cache():
+    global local_cache
+    if local_cache is None:
+        local_cache = cache.LRUCache(current_app.config.get(
+            'MF2_CACHE_SIZE', MF2_CACHE_SIZE))
+    return local_cache
+
+
+def fetch_mf2(url):
+    """A caching replacement for mf2py.parse(url=url). Stale pages are
+    fetched again with a conditional GET, and only reparsed if the body
+    has actually changed.
+    """
+    key = 'mf2:' + hashlib.sha1(url.encode('utf-8')).hexdigest()
+    now = time.time()
+
+    local = get_local_cache()
+    cached = local.get(key)
+    if cached is None:
+        data = cache.redis.get(key)
+        if data:
+            cached = json.loads(data.decode('utf-8'))
+
+    if cached and now - cached['fetched'] < current_app.config.get(
+            'MF2_CACHE_FRESH', MF2_FRESH):
+        cache.redis.hincrby('mf2cache:stats', 'hits', 1)
+        local.set(key, cached)
+        return cached['parsed']
+
+    resp = util.requests_get(url)
+    body_hash = hashlib.sha1(resp.content).hexdigest()
+    if cached and cached['hash'] == body_hash:
+        cache.redis.hincrby('mf2cache:stats', 'revalidated', 1)
+        parsed = cached['parsed']
+    else:
+        cache.redis.hincrby('mf2cache:stats', 'misses', 1)
+        parsed = mf2py.parse(doc=resp.text, url=resp.url)
+
+    cached = {'fetched': now, 'hash': body_hash, 'parsed': parsed}
+    cache.redis.setex(key, MF2_TTL, json.dumps(cached))
+    local.set(key, cached)
+    return parsed
+
+
+def stats():
+    """Shared hit/revalidated/miss counters, plus this process's own
+    in-memory cache.
+    """
+    result = {k.decode(): int(v) for k, v
+              in cache.redis.hgetall('mf2cache:stats').items()}
+    result['local'] = get_local_cache().stats()
+    return result
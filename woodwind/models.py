@@ -1,13 +1,17 @@
 from .extensions import db
 
-from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy.dialects.postgresql import JSON, TSVECTOR
+import collections
+import sqlalchemy.orm
+import urllib.parse
 import uuid
 
 
-entry_to_reply_context = db.Table(
-    'entry_to_reply_context', db.Model.metadata,
+entry_to_context = db.Table(
+    'entry_to_context', db.Model.metadata,
     db.Column('entry_id', db.Integer, db.ForeignKey('entry.id'), index=True),
-    db.Column('context_id', db.Integer, db.ForeignKey('entry.id'), index=True))
+    db.Column('context_id', db.Integer, db.ForeignKey('reply_context.id'),
+              index=True))
 
 
 class User(db.Model):
@@ -70,6 +74,15 @@ class Feed(db.Model):
     last_updated = db.Column(db.DateTime)
     # last time we checked this feed
     last_checked = db.Column(db.DateTime)
+    # next time this feed is due to be polled, computed from the
+    # failure count and push status when it is checked
+    next_check_at = db.Column(db.DateTime, index=True)
+    # typical number of seconds between posts, learned from the
+    # published dates of recent entries
+    post_interval = db.Column(db.Integer)
+    # sha1 of the last feed body we parsed, to skip parsing it again
+    # when it comes back unchanged
+    content_hash = db.Column(db.String(40))
     etag = db.Column(db.String(512))
 
     push_hub = db.Column(db.String(512))
@@ -107,6 +120,29 @@ class Subscription(db.Model):
 
     user = db.relationship(User, backref='subscriptions')
     feed = db.relationship(Feed, backref='subscriptions')
+    # the same tags, one row each, so a tag's timeline is an index lookup
+    tag_rows = db.relationship('SubscriptionTag',
+                               cascade='all, delete-orphan')
+
+    def set_tags(self, tags):
+        """Set the tags from a list of strings, keeping the tags column
+        and tag rows in agreement.
+        """
+        tags = list(collections.OrderedDict.fromkeys(t for t in tags if t))
+        self.tags = ' '.join(tags) or None
+        existing = {row.tag: row for row in self.tag_rows}
+        self.tag_rows = [existing.get(tag) or SubscriptionTag(tag=tag)
+                         for tag in tags]
+
+
+class SubscriptionTag(db.Model):
+    subscription_id = db.Column(db.Integer, db.ForeignKey(Subscription.id),
+                                primary_key=True)
+    tag = db.Column(db.String(256), primary_key=True)
+
+    __table_args__ = (
+        db.Index('ix_subscription_tag_tag', 'tag', 'subscription_id'),
+    )
 
 
 class Entry(db.Model):
@@ -116,7 +152,7 @@ class Entry(db.Model):
     published = db.Column(db.DateTime)
     updated = db.Column(db.DateTime)
     deleted = db.Column(db.DateTime)
-    retrieved = db.Column(db.DateTime, index=True)
+    retrieved = db.Column(db.DateTime)
     uid = db.Column(db.String(512))
     permalink = db.Column(db.String(512), index=True)
     author_name = db.Column(db.String(512))
@@ -125,12 +161,42 @@ class Entry(db.Model):
     title = db.Column(db.Text)
     content = db.Column(db.Text)
     content_cleaned = db.Column(db.Text)
+    # fingerprint of the fields that tell us if a post has been updated
+    content_hash = db.Column(db.String(40))
     # other properties
     properties = db.Column(JSON)
-    reply_context = db.relationship(
-        'Entry', secondary='entry_to_reply_context',
-        primaryjoin=id == entry_to_reply_context.c.entry_id,
-        secondaryjoin=id == entry_to_reply_context.c.context_id)
+    # copies of the properties timelines are filtered on, see update_flags
+    is_jam = db.Column(db.Boolean, default=False)
+    is_event = db.Column(db.Boolean, default=False)
+    is_reply = db.Column(db.Boolean, default=False)
+    is_like = db.Column(db.Boolean, default=False)
+    is_repost = db.Column(db.Boolean, default=False)
+    # title and content_cleaned for full-text search, see search.py
+    search_vector = db.Column(TSVECTOR)
+    reply_context = db.relationship('ReplyContext',
+                                    secondary='entry_to_context')
+
+    # timelines are ordered by (retrieved, published, id) and paged with
+    # a cursor on those columns, both across all feeds and within one
+    __table_args__ = (
+        db.Index('ix_entry_retrieved_published_id',
+                 'retrieved', 'published', 'id'),
+        db.Index('ix_entry_feed_id_retrieved_published_id',
+                 'feed_id', 'retrieved', 'published', 'id'),
+        # a feed stores each uid once, so new entries can be inserted
+        # with ON CONFLICT DO NOTHING
+        db.Index('ix_entry_feed_id_uid', 'feed_id', 'uid', unique=True),
+        # jams and events are rare, so their timelines get small partial
+        # indexes of their own
+        db.Index('ix_entry_jam_retrieved_published_id',
+                 'retrieved', 'published', 'id',
+                 postgresql_where=sqlalchemy.text('is_jam')),
+        db.Index('ix_entry_event_retrieved_published_id',
+                 'retrieved', 'published', 'id',
+                 postgresql_where=sqlalchemy.text('is_event')),
+        db.Index('ix_entry_search_vector', 'search_vector',
+                 postgresql_using='gin'),
+    )
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -138,11 +204,79 @@ class Entry(db.Model):
         self.properties = {}
         self._syndicated_copies = []
 
+    @sqlalchemy.orm.reconstructor
+    def init_on_load(self):
+        self.subscription = None
+        self._syndicated_copies = []
+
     def get_property(self, key, default=None):
         return self.properties.get(key, default)
 
     def set_property(self, key, value):
         self.properties[key] = value
 
+    def update_flags(self):
+        """Copy the properties that timelines are filtered on into their
+        own columns, so that the filters can use indexes.
+        """
+        self.is_jam = bool(self.get_property('jam'))
+        self.is_event = bool(self.get_property('event'))
+        self.is_reply = bool(self.get_property('in-reply-to'))
+        self.is_like = bool(self.get_property('like-of'))
+        self.is_repost = bool(self.get_property('repost-of'))
+
     def __repr__(self):
         return '<Entry:{},{}>'.format(self.title, (self.content or '')[:140])
+
+
+class ReplyContext(db.Model):
+    """A post that entries reply to (or like, or repost), stored once per
+    normalized permalink, however many entries refer to it.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    normalized_permalink = db.Column(db.String(512), unique=True)
+    permalink = db.Column(db.String(512))
+    published = db.Column(db.DateTime)
+    author_name = db.Column(db.String(512))
+    author_url = db.Column(db.String(512))
+    author_photo = db.Column(db.String(512))
+    title = db.Column(db.Text)
+    content = db.Column(db.Text)
+    content_cleaned = db.Column(db.Text)
+    # when the post was last fetched
+    fetched = db.Column(db.DateTime)
+
+    @staticmethod
+    def normalize_permalink(url):
+        """Lowercase the scheme and host, and drop the fragment and any
+        default port, which don't change the post a url points to.
+        """
+        parts = urllib.parse.urlsplit(url.strip())
+        scheme = parts.scheme.lower()
+        netloc = parts.netloc.lower()
+        if (scheme, netloc.rpartition(':')[2]) in (('http', '80'),
+                                                   ('https', '443')):
+            netloc = netloc.rpartition(':')[0]
+        return urllib.parse.urlunsplit(
+            (scheme, netloc, parts.path or '/', parts.query, ''))
+
+    @staticmethod
+    def load_for(entries):
+        """Fill in the reply contexts of many entries with one query,
+        instead of one per entry.
+        """
+        by_entry = {entry.id: [] for entry in entries}
+        if by_entry:
+            rows = db.session.query(entry_to_context.c.entry_id, ReplyContext)\
+                .join(ReplyContext,
+                      ReplyContext.id == entry_to_context.c.context_id)\
+                .filter(entry_to_context.c.entry_id.in_(list(by_entry)))\
+                .order_by(ReplyContext.id)
+            for entry_id, context in rows:
+                by_entry[entry_id].append(context)
+        for entry in entries:
+            sqlalchemy.orm.attributes.set_committed_value(
+                entry, 'reply_context', by_entry[entry.id])
+
+    def __repr__(self):
+        return '<ReplyContext:{}>'.format(self.permalink)
@@ -0,0 +1,146 @@
+"""Share one redis subscription between all of the clients connected to
+a websocket or SSE server process, instead of opening a redis
+connection per client.
+"""
+import asyncio
+import asyncio_redis
+import logging
+
+logger = logging.getLogger(__name__)
+
+# messages queued for one client before it is considered too slow to
+# keep up, and is disconnected
+MAX_QUEUED = 100
+# after losing redis, retry with a delay that doubles up to the maximum;
+# clients are disconnected if the first few attempts fail
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+RECONNECT_ATTEMPTS = 4
+
+
+class Listener:
+    """One client's view of a topic. Messages are queued until the client
+    reads them; get() returns None once the client has been dropped.
+    """
+    def __init__(self, channel, maxsize):
+        self.channel = channel
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.dropped = False
+
+    @asyncio.coroutine
+    def get(self):
+        return (yield from self.queue.get())
+
+
+class NotifyHub:
+    def __init__(self, max_queued=MAX_QUEUED):
+        self.max_queued = max_queued
+        self.listeners = {}
+        self.lock = asyncio.Lock()
+        self.connection = None
+        self.subscriber = None
+
+    @asyncio.coroutine
+    def start(self):
+        yield from self.connect()
+        asyncio.ensure_future(self.dispatch())
+
+    @asyncio.coroutine
+    def connect(self):
+        self.connection = yield from asyncio_redis.Connection.create()
+        self.subscriber = yield from self.connection.start_subscribe()
+
+    @asyncio.coroutine
+    def subscribe(self, topic):
+        """Start listening to a topic, subscribing to its redis channel if
+        this is the first local client interested in it.
+        """
+        listener = Listener('woodwind_notify:' + topic, self.max_queued)
+        with (yield from self.lock):
+            listeners = self.listeners.get(listener.channel)
+            if listeners is None:
+                yield from self.subscriber.subscribe([listener.channel])
+                listeners = self.listeners[listener.channel] = set()
+            listeners.add(listener)
+        return listener
+
+    @asyncio.coroutine
+    def unsubscribe(self, listener):
+        """Stop listening, and drop the redis channel subscription once
+        the last local client has gone.
+        """
+        with (yield from self.lock):
+            listeners = self.listeners.get(listener.channel)
+            if listeners is None:
+                return
+            listeners.discard(listener)
+            if not listeners:
+                del self.listeners[listener.channel]
+                yield from self.subscriber.unsubscribe([listener.channel])
+
+    @asyncio.coroutine
+    def dispatch(self):
+        while True:
+            try:
+                message = yield from self.subscriber.next_published()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('lost the redis subscription')
+                yield from self.reconnect()
+                continue
+
+            for listener in list(self.listeners.get(message.channel, ())):
+                if listener.dropped:
+                    continue
+                try:
+                    listener.queue.put_nowait(message.value)
+                except asyncio.QueueFull:
+                    self.drop(listener)
+
+    @asyncio.coroutine
+    def reconnect(self):
+        """Connect to redis again and resubscribe to every channel a
+        client is listening on. Clients are disconnected (and so can
+        reconnect somewhere that works) if that keeps failing, but we
+        carry on trying for the sake of new ones.
+        """
+        with (yield from self.lock):
+            if self.connection:
+                try:
+                    self.connection.close()
+                except Exception:
+                    pass
+
+            delay = RECONNECT_DELAY
+            attempt = 0
+            while True:
+                attempt += 1
+                try:
+                    yield from self.connect()
+                    if self.listeners:
+                        yield from self.subscriber.subscribe(
+                            list(self.listeners))
+                    logger.info('reconnected to redis, resubscribed to %d '
+                                'channels', len(self.listeners))
+                    return
+                except Exception:
+                    logger.exception('reconnecting to redis failed '
+                                     '(attempt %d)', attempt)
+
+                if attempt == RECONNECT_ATTEMPTS:
+                    for listeners in self.listeners.values():
+                        for listener in listeners:
+                            self.drop(listener)
+                    self.listeners.clear()
+                yield from asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    def drop(self, listener):
+        """Throw away a slow client's backlog and tell it to disconnect,
+        rather than letting it hold an unbounded amount of memory.
+        """
+        listener.dropped = True
+        while not listener.queue.empty():
+            listener.queue.get_nowait()
+        listener.queue.put_nowait(None)
@@ -4,19 +4,26 @@ from .models import Feed
 from flask import Blueprint, request, abort, current_app, make_response
 import datetime
 import hmac
+import json
+import time
 
 
 push = Blueprint('push', __name__)
 
+# seconds to cache each feed's PuSH secret
+SECRET_TTL = 24 * 60 * 60
+# pings waiting to be drained beyond this many are dropped, oldest first
+MAX_QUEUED_PINGS = 100000
+
 
 @push.route('/_notify/<int:feed_id>', methods=['GET', 'POST'])
 def notify(feed_id):
     current_app.logger.debug(
         'received PuSH notification for feed id %d', feed_id)
-    feed = Feed.query.get(feed_id)
-
-    current_app.logger.debug('processing PuSH notification for feed %r', feed)
     if request.method == 'GET':
+        feed = Feed.query.get(feed_id)
+        current_app.logger.debug(
+            'processing PuSH verification for feed %r', feed)
         # verify subscribe or unsusbscribe
         mode = request.args.get('hub.mode')
         topic = request.args.get('hub.topic')
@@ -46,6 +53,7 @@ def notify(feed_id):
             if lease_seconds:
                 feed.push_expiry = datetime.datetime.utcnow() \
                     + datetime.timedelta(seconds=int(lease_seconds))
+            tasks.schedule_next_check(feed)
             db.session.commit()
             return challenge
 
@@ -67,35 +75,60 @@ def notify(feed_id):
             current_app.logger.debug('PuSH request with no mode')
             return make_response('missing requred parameter hub.mode', 400)
 
-    if not feed:
+    secret = get_push_secret(feed_id)
+    if secret is None:
         current_app.logger.warn(
             'could not find feed corresponding to %d', feed_id)
         return make_response('no feed with id %d' % feed_id, 400)
 
     # could it be? an actual push notification!?
     current_app.logger.debug(
-        'received PuSH ping for %r; content size: %d', feed, len(request.data))
+        'received PuSH ping for feed %d; content size: %d',
+        feed_id, len(request.data))
 
     # try to process fat pings
     content = None
     content_type = None
     signature = request.headers.get('X-Hub-Signature')
-    if signature and feed.push_secret and request.data:
-        expected = 'sha1=' + hmac.new(feed.push_secret.encode('utf-8'),
+    if signature and secret and request.data:
+        expected = 'sha1=' + hmac.new(secret.encode('utf-8'),
                      msg=request.data, digestmod='sha1').hexdigest()
-        if expected != signature:
+        if not hmac.compare_digest(expected, signature):
             current_app.logger.warn(
                 'X-Hub-Signature (%s) did not match expected (%s)',
                 signature, expected)
             return make_response('', 204)
-        current_app.logger.info('Good X-Hub-Signature!')
         content_type = request.headers.get('Content-Type')
-        current_app.logger.info('PuSH content type: %s', content_type)
         content = request.data.decode('utf-8')
 
-    tasks.q_high.enqueue(tasks.update_feed, feed.id,
-                         content=content, content_type=content_type,
-                         is_polling=False)
-    feed.last_pinged = datetime.datetime.utcnow()
-    db.session.commit()
+    # hand the ping off to drain_push_pings, so that a storm of them
+    # never touches the database from here
+    pipe = tasks.redis.pipeline()
+    # newest first, so that the oldest are dropped if the queue is full
+    pipe.lpush('push:pings', json.dumps({
+        'feed': feed_id,
+        'content': content,
+        'content_type': content_type,
+        'received': time.time(),
+    }))
+    pipe.ltrim('push:pings', 0, MAX_QUEUED_PINGS - 1)
+    pipe.execute()
+    if tasks.redis.set('push:drain', 1, ex=tasks.JOB_LOCK_TTL, nx=True):
+        tasks.enqueue_drain_push_pings()
     return make_response('', 204)
+
+
+def get_push_secret(feed_id):
+    """The feed's PuSH secret, '' if it doesn't have one, or None if there
+    is no such feed. Cached in redis, since pings for a feed all need it.
+    """
+    key = 'push:secret:%d' % feed_id
+    secret = tasks.redis.get(key)
+    if secret is not None:
+        return secret.decode()
+
+    row = db.session.query(Feed.push_secret).filter(Feed.id == feed_id).first()
+    if row is None:
+        return None
+    tasks.redis.setex(key, SECRET_TTL, row.push_secret or '')
+    return row.push_secret or ''
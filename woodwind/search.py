@@ -0,0 +1,59 @@
+"""Full-text search over entries. Each entry's title and cleaned content
+are indexed into a tsvector column (with a GIN index) when update_feed
+stores it, and searches are ranked with ts_rank_cd over the entries of
+the user's subscriptions.
+"""
+from flask import current_app
+from woodwind.extensions import db
+from woodwind.models import Entry, Feed, Subscription
+import sqlalchemy
+import sqlalchemy.orm
+
+# the postgres text search configuration used to index and query
+SEARCH_CONFIG = 'english'
+
+
+def get_config():
+    return current_app.config.get('SEARCH_CONFIG', SEARCH_CONFIG)
+
+
+def document():
+    """The indexed text of an entry: its title, weighted above its
+    content. Markup in the content is skipped by the parser.
+    """
+    func = sqlalchemy.func
+    config = get_config()
+    return func.setweight(
+        func.to_tsvector(config, func.coalesce(Entry.title, '')), 'A'
+    ).op('||')(func.setweight(
+        func.to_tsvector(config, func.coalesce(Entry.content_cleaned, '')),
+        'B'))
+
+
+def index_entries(entry_ids):
+    """Index the given entries, in one statement.
+    """
+    if entry_ids:
+        Entry.query.filter(Entry.id.in_(entry_ids))\
+                   .update({'search_vector': document()},
+                           synchronize_session=False)
+
+
+def search(user_id, text, page, per_page):
+    """Returns a page of (entry, subscription) tuples from a user's
+    subscriptions that match the text, best match first.
+    """
+    query = sqlalchemy.func.plainto_tsquery(get_config(), text)
+    rank = sqlalchemy.func.ts_rank_cd(Entry.search_vector, query)
+    now = db.func.now()
+    return db.session.query(Entry, Subscription)\
+        .options(sqlalchemy.orm.subqueryload(Entry.feed))\
+        .join(Entry.feed)\
+        .join(Feed.subscriptions)\
+        .filter(Subscription.user_id == user_id)\
+        .filter(Entry.search_vector.op('@@')(query))\
+        .filter(db.or_(Entry.deleted == None, Entry.deleted >= now))\
+        .order_by(rank.desc(), Entry.retrieved.desc(), Entry.id.desc())\
+        .offset((page - 1) * per_page)\
+        .limit(per_page)\
+        .all()
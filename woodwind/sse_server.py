@@ -1,6 +1,8 @@
 from aiohttp import web
+from woodwind.notify_hub import NotifyHub
 import asyncio
-import asyncio_redis
+
+hub = NotifyHub()
 
 
 @asyncio.coroutine
@@ -9,22 +11,24 @@ def handle_subscription(request):
     response = web.StreamResponse()
     response.headers['Content-Type'] = 'text/event-stream'
     response.start(request)
-    redis = yield from asyncio_redis.Connection.create()
+    listener = yield from hub.subscribe(topic)
     try:
-        ps = yield from redis.start_subscribe()
-        yield from ps.subscribe(['woodwind_notify:' + topic])
         while True:
-            message = yield from ps.next_published()
+            message = yield from listener.get()
+            if message is None:
+                break
             response.write(
-                'data: {}\n\n'.format(message.value).encode('utf-8'))
+                'data: {}\n\n'.format(message).encode('utf-8'))
     finally:
-        redis.close()
+        yield from hub.unsubscribe(listener)
+    return response
 
 
 app = web.Application()
 app.router.add_route('GET', '/', handle_subscription)
 
 loop = asyncio.get_event_loop()
+loop.run_until_complete(hub.start())
 srv = loop.run_until_complete(
     loop.create_server(app.make_handler(), '0.0.0.0', 8077))
 loop.run_forever()
@@ -1,13 +1,17 @@
 from contextlib import contextmanager
 from flask import current_app, url_for
-from redis import StrictRedis
-from woodwind import util
+from redis import StrictRedis, WatchError
+from woodwind import cache, fetcher, http_client, mf2cache, search, \
+    timeline, util
 from woodwind.extensions import db
-from woodwind.models import Feed, Entry
+from woodwind.models import Feed, Entry, ReplyContext, Subscription, \
+    entry_to_context
 import sqlalchemy
+import sqlalchemy.dialects.postgresql
 import bs4
 import datetime
 import feedparser
+import hashlib
 import itertools
 import json
 import mf2py
@@ -22,8 +26,48 @@ import urllib.parse
 
 # normal update interval for polling feeds
 UPDATE_INTERVAL = datetime.timedelta(hours=1)
+# default bounds for the adaptive polling interval, in seconds
+UPDATE_INTERVAL_MIN = 15 * 60
+UPDATE_INTERVAL_MAX = 24 * 60 * 60
+# number of recent entries used to learn how often a feed posts
+POST_HISTORY = 20
 # update interval when polling feeds that are push verified
 UPDATE_INTERVAL_PUSH = datetime.timedelta(days=1)
+# seconds a batch of concurrent feed fetches is allowed to run
+BATCH_TIMEOUT = 60 * 60
+# seconds a due feed is held back from being enqueued again, in case
+# its update never runs
+UPDATE_LEASE = 3 * 60 * 60
+# seconds before the lock on a queue-draining job is assumed abandoned
+JOB_LOCK_TTL = 10 * 60
+# number of in-reply-to urls fetched at once, and the seconds after
+# which a job stops starting new batches
+REPLY_CONTEXT_BATCH = 20
+REPLY_CONTEXT_JOB_BUDGET = 2 * 60
+# reply contexts are fetched again when an entry refers to them and
+# they are more than this many seconds old
+REPLY_CONTEXT_REFRESH = 7 * 24 * 60 * 60
+# number of queued PuSH pings handled at once
+PUSH_DRAIN_BATCH = 500
+# jobs that drain a redis queue handle at most this many batches, and
+# then enqueue a fresh job to carry on, so no one job outlives its
+# timeout (which must stay under JOB_LOCK_TTL)
+DRAIN_JOB_BATCHES = 10
+DRAIN_JOB_TIMEOUT = 5 * 60
+# default limits on how much of a feed we download: its size in bytes,
+# and the number of (newest) items read from an xml feed
+MAX_FEED_SIZE = 5 * 1024 * 1024
+MAX_FEED_ITEMS = 100
+# xml feeds found to list their items oldest first are read in full,
+# since the item limit would keep only their oldest items
+OLDEST_FIRST_KEY = 'feeds:oldestfirst'
+# each feed keeps at most this many entries, none older than this many
+# days; prune_entries deletes the rest a batch at a time, pausing
+# between batches to leave the database room for everything else
+RETENTION_MAX_ENTRIES = 2000
+RETENTION_MAX_DAYS = 365
+RETENTION_BATCH_SIZE = 500
+RETENTION_PAUSE = 0.5
 
 TWITTER_RE = re.compile(
     r'https?://(?:www\.|mobile\.)?twitter\.com/(\w+)/status(?:es)?/(\w+)')
@@ -37,6 +81,11 @@ AUDIO_ENCLOSURE_TMPL = '<p><audio class="u-audio" src="{href}" controls '\
 VIDEO_ENCLOSURE_TMPL = '<p><video class="u-video" src="{href}" controls '\
                        'preload=none ><a href="{href}">video</a></video></p>'
 
+# markers left in entries rendered once for all subscribers, replaced
+# with each subscriber's own subscription header and reply area
+SUBSCRIPTION_SLOT = '<!--woodwind:subscription-->'
+REPLY_SLOT = '<!--woodwind:reply-->'
+
 redis = StrictRedis()
 q_high = rq.Queue('high', connection=redis)
 q = rq.Queue('low', connection=redis)
@@ -44,17 +93,6 @@ q = rq.Queue('low', connection=redis)
 
 _app = None
 
-class Mf2Fetcher:
-    def __init__(self):
-        self.cache = {}
-
-    def __call__(self, url):
-        if url in self.cache:
-            return self.cache[url]
-        p = mf2py.parse(url=url)
-        self.cache[url] = p
-        return p
-
 
 @contextmanager
 def flask_app():
@@ -74,40 +112,155 @@ def tick():
     Makes use of uWSGI timers to run every 5 minutes, without needing
     a separate process to fire ticks.
     """
-    def should_update(feed, now):
-        if not feed.last_checked:
-            return True
+    with flask_app():
+        now = datetime.datetime.utcnow()
+        current_app.logger.info('Tick {}'.format(now))
+        # lease the due feeds as we select them, so that feeds still
+        # waiting in the queue aren't enqueued again by the next tick;
+        # update_feed schedules the real next check when it finishes
+        lease = datetime.timedelta(seconds=current_app.config.get(
+            'UPDATE_LEASE', UPDATE_LEASE))
+        due = Feed.__table__.update()\
+            .where(db.or_(Feed.next_check_at == None,
+                          Feed.next_check_at <= now))\
+            .where(Feed.subscriptions.any())\
+            .values(next_check_at=now + lease)\
+            .returning(Feed.id)
+        due_ids = [feed_id for feed_id, in db.session.execute(due)]
+        db.session.commit()
+        current_app.logger.debug('%d feeds are due for an update',
+                                 len(due_ids))
+
+        batch_size = current_app.config.get('FETCH_BATCH_SIZE')
+        if batch_size:
+            for ii in range(0, len(due_ids), batch_size):
+                q.enqueue_call(func=update_feeds,
+                               args=(due_ids[ii:ii + batch_size],),
+                               timeout=BATCH_TIMEOUT)
+        else:
+            for feed_id in due_ids:
+                q.enqueue(update_feed, feed_id)
 
-        if not feed.subscriptions:
-            return False
 
-        if feed.failure_count > 8:
-            update_interval = datetime.timedelta(days=1)
-        elif feed.failure_count > 4:
-            update_interval = datetime.timedelta(hours=8)
-        elif feed.failure_count > 2:
-            update_interval = datetime.timedelta(hours=4)
-        else:
-            update_interval = UPDATE_INTERVAL
+def get_update_interval(feed):
+    """How long to wait between polls of a feed. Adapts to how often the
+    feed posts, backs off when it has been failing, and polls less often
+    when it is PuSH verified.
+    """
+    update_interval = get_adaptive_interval(feed)
 
-        # PuSH feeds don't need to poll very frequently
-        if feed.push_verified:
-            update_interval = max(update_interval, UPDATE_INTERVAL_PUSH)
+    if feed.failure_count > 8:
+        update_interval = max(update_interval, datetime.timedelta(days=1))
+    elif feed.failure_count > 4:
+        update_interval = max(update_interval, datetime.timedelta(hours=8))
+    elif feed.failure_count > 2:
+        update_interval = max(update_interval, datetime.timedelta(hours=4))
 
-        return now - feed.last_checked > update_interval
+    # PuSH feeds don't need to poll very frequently
+    if feed.push_verified:
+        update_interval = max(update_interval, UPDATE_INTERVAL_PUSH)
 
-    with flask_app():
-        now = datetime.datetime.utcnow()
-        current_app.logger.info('Tick {}'.format(now))
-        for feed in Feed.query.all():
-            current_app.logger.debug(
-                'Feed %s last checked %s', feed, feed.last_checked)
-            if should_update(feed, now):
-                q.enqueue(update_feed, feed.id)
+    return update_interval
+
+
+def get_adaptive_interval(feed):
+    """Poll about twice per typical gap between posts, and back off when
+    the feed has been quiet for longer than usual. The result is kept
+    between UPDATE_INTERVAL_MIN and UPDATE_INTERVAL_MAX.
+    """
+    floor = datetime.timedelta(seconds=current_app.config.get(
+        'UPDATE_INTERVAL_MIN', UPDATE_INTERVAL_MIN))
+    ceiling = datetime.timedelta(seconds=current_app.config.get(
+        'UPDATE_INTERVAL_MAX', UPDATE_INTERVAL_MAX))
+
+    if feed.post_interval:
+        interval = datetime.timedelta(seconds=feed.post_interval / 2)
+    else:
+        interval = UPDATE_INTERVAL
+
+    if feed.last_updated and feed.last_checked:
+        quiet = feed.last_checked - feed.last_updated
+        interval = max(interval, quiet / 4)
+
+    return min(max(interval, floor), ceiling)
+
+
+def learn_post_interval(feed):
+    """Find the median number of seconds between the feed's recent posts,
+    or None if there is not enough history to tell.
+    """
+    published = [p for p, in db.session.query(Entry.published)
+                 .filter(Entry.feed_id == feed.id, Entry.published != None)
+                 .order_by(Entry.published.desc())
+                 .limit(POST_HISTORY)]
+    gaps = sorted((newer - older).total_seconds()
+                  for newer, older in zip(published, published[1:]))
+    if gaps:
+        return max(int(gaps[len(gaps) // 2]), 1)
+
+
+def schedule_next_check(feed):
+    """Store the next time this feed should be polled, so that tick can
+    find the feeds that are due without looking at every one of them.
+    """
+    if feed.last_checked:
+        feed.next_check_at = feed.last_checked + get_update_interval(feed)
+    else:
+        feed.next_check_at = None
+
+
+def update_feeds(feed_ids):
+    """Fetch a batch of feeds concurrently, then hand each response to
+    update_feed to be parsed and stored.
+    """
+    responses = {}
+    with flask_app() as app:
+        feeds = db.session.query(Feed.id, Feed.feed, Feed.type)\
+                          .filter(Feed.id.in_(feed_ids)).all()
+        urls = {feed_id: url for feed_id, url, _ in feeds}
+        max_size, max_items = get_fetch_limits()
+        oldest_first = get_oldest_first_feeds()
+        current_app.logger.info('Fetching a batch of %d feeds', len(urls))
+        responses = fetcher.fetch_all(
+            urls,
+            concurrency=app.config.get('FETCH_CONCURRENCY',
+                                       fetcher.CONCURRENCY),
+            per_host=app.config.get('FETCH_PER_HOST', fetcher.PER_HOST),
+            max_size=max_size,
+            max_items={feed_id: max_items for feed_id, _, type in feeds
+                       if type == 'xml' and feed_id not in oldest_first})
+
+    for feed_id, response in responses.items():
+        update_feed(feed_id, response=response)
+
+
+def get_fetch_limits():
+    """The most bytes we'll download of any feed, and the most items
+    we'll read of an xml feed, so that one giant feed can't take up all
+    of a worker's memory.
+    """
+    return (current_app.config.get('MAX_FEED_SIZE', MAX_FEED_SIZE),
+            current_app.config.get('MAX_FEED_ITEMS', MAX_FEED_ITEMS))
+
+
+def get_oldest_first_feeds():
+    return {int(feed_id) for feed_id in redis.smembers(OLDEST_FIRST_KEY)}
+
+
+def lists_oldest_first(entries):
+    """Whether the document listed these entries oldest first. The xml
+    processor hands them to us in reverse document order.
+    """
+    dates = [entry.published for entry in entries if entry.published]
+    return len(dates) > 1 and dates[0] > dates[-1]
 
 
 def update_feed(feed_id, content=None,
-                content_type=None, is_polling=True):
+                content_type=None, is_polling=True, response=None):
+    """Fetch a feed and store any new or changed entries. Fat pings
+    provide the content directly, and batch polling provides an already
+    fetched response (or the exception raised while fetching it).
+    """
 
     def is_expected_content_type(feed_type):
         if not content_type:
@@ -131,9 +284,9 @@ def update_feed(feed_id, content=None,
 
         new_entries = []
         updated_entries = []
+        replaced_ids = []
         reply_pairs = []
 
-        fetch_mf2 = Mf2Fetcher()
         try:
             if content and is_expected_content_type(feed.type):
                 current_app.logger.info('using provided content. size=%d',
@@ -142,7 +295,15 @@ def update_feed(feed_id, content=None,
                 current_app.logger.info('fetching feed: %s', str(feed)[:32])
 
                 try:
-                    response = util.requests_get(feed.feed)
+                    if response is None:
+                        max_size, max_items = get_fetch_limits()
+                        if (feed.type != 'xml'
+                                or feed.id in get_oldest_first_feeds()):
+                            max_items = None
+                        response = util.requests_get(
+                            feed.feed, max_size=max_size, max_items=max_items)
+                    elif isinstance(response, Exception):
+                        raise response
                 except:
                     feed.last_response = 'exception while retrieving: {}'.format(
                         sys.exc_info()[0])
@@ -165,88 +326,357 @@ def update_feed(feed_id, content=None,
                     check_push_subscription(feed, response)
                 content = get_response_content(response)
 
+            # servers that ignore conditional GETs (and hubs that resend
+            # the same fat ping) hand us identical content, which there
+            # is no need to parse again
+            content_hash = hashlib.sha1(content.encode('utf-8')).hexdigest()
+            if content_hash == feed.content_hash:
+                current_app.logger.info('feed content is unchanged: %s',
+                                        str(feed)[:32])
+                return
+
             # backfill if this is the first pull
-            backfill = len(feed.entries) == 0
+            backfill = not db.session.query(
+                Entry.query.filter(Entry.feed_id == feed.id).exists()
+            ).scalar()
             if feed.type == 'xml':
                 result = process_xml_feed_for_new_entries(
                     feed, content, backfill, now)
             elif feed.type == 'html':
                 result = process_html_feed_for_new_entries(
-                    feed, content, backfill, now, fetch_mf2)
+                    feed, content, backfill, now, mf2cache.fetch_mf2)
             else:
                 result = []
 
             # realize list, only look at the first 30 entries
             result = list(itertools.islice(result, 30))
 
+            if getattr(response, 'truncated', False):
+                current_app.logger.info('read only the first items of %s',
+                                        feed.feed)
+                if lists_oldest_first(result):
+                    # the items we kept are its oldest; read it in full
+                    # from now on, and again right away
+                    current_app.logger.warn(
+                        '%s lists its oldest items first, fetching it in full',
+                        feed.feed)
+                    redis.sadd(OLDEST_FIRST_KEY, feed.id)
+                    cache.delete_response(feed.feed)
+                    q.enqueue(update_feed, feed.id)
+                    return
+
+            # look up the fingerprints of the versions of these entries
+            # we already have, and compare them to the new ones
             old_entries = {}
             all_uids = [e.uid for e in result]
             if all_uids:
-                for entry in (Entry.query
-                              .filter(Entry.feed == feed,
-                                      Entry.uid.in_(all_uids))
-                              .order_by(Entry.id.desc())):
-                    old_entries[entry.uid] = entry
+                for old in (db.session.query(Entry.id, Entry.uid,
+                                             Entry.content_hash,
+                                             Entry.retrieved, Entry.published)
+                            .filter(Entry.feed_id == feed.id,
+                                    Entry.uid.in_(all_uids))):
+                    old_entries[old.uid] = old
 
             for entry in result:
                 old = old_entries.get(entry.uid)
                 current_app.logger.debug(
                     'entry for uid %s: %s', entry.uid,
                     'found' if old else 'not found')
+                entry.content_hash = content_fingerprint(entry)
 
                 # have we seen this post before
                 if not old:
                     current_app.logger.debug('this is a new post, saving a new entry')
                     # set a default value for published if none is provided
                     entry.published = entry.published or now
-                    in_reply_tos = entry.get_property('in-reply-to', [])
-                    db.session.add(entry)
-                    feed.entries.append(entry)
-
                     new_entries.append(entry)
-                    for irt in in_reply_tos:
-                        reply_pairs.append((entry, irt))
 
-                elif not is_content_equal(old, entry):
+                elif old.content_hash != entry.content_hash:
                     current_app.logger.debug('this post content has changed, updating entry')
 
                     entry.published = entry.published or old.published
-                    in_reply_tos = entry.get_property('in-reply-to', [])
                     # we're updating an old entriy, use the original
                     # retrieved time
                     entry.retrieved = old.retrieved
-                    old.feed = None  # feed.entries.remove(old)
                     # punt on deleting for now, learn about cascade
                     # and stuff later
-                    # session.delete(old)
-                    db.session.add(entry)
-                    feed.entries.append(entry)
-
+                    replaced_ids.append(old.id)
                     updated_entries.append(entry)
-                    for irt in in_reply_tos:
-                        reply_pairs.append((entry, irt))
 
                 else:
                     current_app.logger.debug(
-                        'skipping previously seen post %s', old.permalink)
-
-            fetch_reply_contexts(reply_pairs, now, fetch_mf2)
+                        'skipping previously seen post %s', entry.uid)
+
+            # detach the old versions of updated entries before their
+            # replacements are inserted
+            if replaced_ids:
+                Entry.query.filter(Entry.id.in_(replaced_ids))\
+                           .update({'feed_id': None},
+                                   synchronize_session=False)
+            # only clean the content (and set the flags) of entries we
+            # are actually storing
+            for entry in new_entries + updated_entries:
+                entry.content_cleaned = util.clean(entry.content)
+                entry.update_flags()
+
+            new_uids = set(e.uid for e in new_entries)
+            stored = insert_entries(feed, new_entries + updated_entries)
+            search.index_entries([e.id for e in stored])
+            new_entries = [e for e in stored if e.uid in new_uids]
+            updated_entries = [e for e in stored if e.uid not in new_uids]
+
+            for entry in stored:
+                for irt in entry.get_property('in-reply-to', []):
+                    reply_pairs.append((entry, irt))
+
+            pending_contexts = attach_reply_contexts(reply_pairs)
+            feed.content_hash = content_hash
             db.session.commit()
+            # only once the entries are visible to the job
+            queue_reply_contexts(pending_contexts)
+            timeline.push_entries(feed.id, new_entries + updated_entries,
+                                  replaced_ids)
         except:
             db.session.rollback()
             raise
 
         finally:
-            if is_polling:
-                feed.last_checked = now
             if new_entries or updated_entries:
                 feed.last_updated = now
+            if new_entries or not feed.post_interval:
+                feed.post_interval = learn_post_interval(feed)
+            if is_polling:
+                feed.last_checked = now
+                schedule_next_check(feed)
             db.session.commit()
 
             if new_entries:
                 notify_feed_updated(app, feed_id, new_entries)
 
 
+def queue_push_update(feed_id, content=None, content_type=None):
+    """Record a PuSH ping, and start an update for the feed unless one is
+    already waiting or running. The pings it hasn't seen yet are merged
+    into that update, with the newest fat ping's body taking precedence.
+    """
+    pipe = redis.pipeline()
+    if content is None:
+        pipe.delete('push:content:%d' % feed_id)
+    else:
+        pipe.set('push:content:%d' % feed_id, json.dumps({
+            'content': content,
+            'content_type': content_type,
+        }), ex=JOB_LOCK_TTL)
+    pipe.set('push:dirty:%d' % feed_id, 1, ex=JOB_LOCK_TTL)
+    pipe.execute()
+
+    if redis.set('push:job:%d' % feed_id, 1, ex=JOB_LOCK_TTL, nx=True):
+        q_high.enqueue(push_update, feed_id)
+
+
+def enqueue_drain_push_pings():
+    q_high.enqueue_call(func=drain_push_pings, timeout=DRAIN_JOB_TIMEOUT)
+
+
+def drain_push_pings():
+    """Take the pings the PuSH endpoint queued up in redis, in batches:
+    record when each feed was last pinged, with one commit per batch, and
+    hand each ping to queue_push_update. Handles a bounded number of
+    batches, then hands off to a new job if there are more.
+    """
+    with flask_app():
+        try:
+            for _ in range(DRAIN_JOB_BATCHES):
+                pings = take_push_pings()
+                if not pings:
+                    break
+
+                last_pinged = {}
+                for ping in pings:
+                    last_pinged[ping['feed']] = max(
+                        ping['received'], last_pinged.get(ping['feed'], 0))
+                for feed_id, received in last_pinged.items():
+                    Feed.query.filter(Feed.id == feed_id).update(
+                        {'last_pinged': datetime.datetime.utcfromtimestamp(
+                            received)},
+                        synchronize_session=False)
+                db.session.commit()
+
+                for ping in pings:
+                    queue_push_update(ping['feed'], content=ping['content'],
+                                      content_type=ping['content_type'])
+                # only now are the pings safely handled
+                redis.delete('push:pings:processing')
+        except:
+            # let the next ping start a new job
+            redis.delete('push:drain')
+            raise
+
+        if not release_job_if_idle('push:drain', 'push:pings'):
+            redis.expire('push:drain', JOB_LOCK_TTL)
+            enqueue_drain_push_pings()
+
+
+def take_push_pings():
+    """The next batch of pings, oldest first. They stay in a processing
+    list until the batch is handled, so a job that dies partway through
+    leaves them for the next one.
+    """
+    pings = redis.lrange('push:pings:processing', 0, -1)
+    if pings:
+        pings.reverse()
+    else:
+        pipe = redis.pipeline(transaction=False)
+        for _ in range(PUSH_DRAIN_BATCH):
+            pipe.rpoplpush('push:pings', 'push:pings:processing')
+        pings = [ping for ping in pipe.execute() if ping]
+    return [json.loads(ping.decode()) for ping in pings]
+
+
+def push_update(feed_id):
+    """Update the feed once for every ping received so far, including
+    those that arrived while this job waited in the queue. If more
+    arrived while it ran, go around again. (rq can't delay a job, so
+    there is no waiting for more pings beyond the time spent queued.)
+    """
+    with flask_app():
+        pipe = redis.pipeline()
+        pipe.get('push:content:%d' % feed_id)
+        pipe.delete('push:content:%d' % feed_id)
+        pipe.delete('push:dirty:%d' % feed_id)
+        fat_ping, _, _ = pipe.execute()
+        fat_ping = json.loads(fat_ping.decode()) if fat_ping else {}
+
+        try:
+            update_feed(feed_id, content=fat_ping.get('content'),
+                        content_type=fat_ping.get('content_type'),
+                        is_polling=False)
+        finally:
+            if not release_job_if_idle('push:job:%d' % feed_id,
+                                       'push:dirty:%d' % feed_id):
+                redis.expire('push:job:%d' % feed_id, JOB_LOCK_TTL)
+                q_high.enqueue(push_update, feed_id)
+
+
+def prune_entries():
+    """Delete entries that are past the retention limits, one feed and one
+    batch at a time, along with their links to reply contexts, and then
+    any contexts no entry refers to anymore. Entries detached from their
+    feed (replaced by an update) are pruned as if they were one more feed.
+    """
+    with flask_app() as app:
+        config = app.config
+        max_entries = config.get('RETENTION_MAX_ENTRIES',
+                                 RETENTION_MAX_ENTRIES)
+        max_days = config.get('RETENTION_MAX_DAYS', RETENTION_MAX_DAYS)
+        batch_size = config.get('RETENTION_BATCH_SIZE', RETENTION_BATCH_SIZE)
+        pause = config.get('RETENTION_PAUSE', RETENTION_PAUSE)
+
+        started = time.time()
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+            days=max_days)
+        removed = {'entries': 0, 'links': 0, 'contexts': 0}
+
+        feed_ids = [None] + [
+            feed_id for feed_id, in db.session.query(Feed.id)
+            .order_by(Feed.id)]
+        for feed_id in feed_ids:
+            while True:
+                entry_ids = prunable_entry_ids(
+                    feed_id, cutoff, max_entries, batch_size)
+                if not entry_ids:
+                    break
+                removed['links'] += db.session.execute(
+                    entry_to_context.delete().where(
+                        entry_to_context.c.entry_id.in_(entry_ids))).rowcount
+                removed['entries'] += Entry.query\
+                    .filter(Entry.id.in_(entry_ids))\
+                    .delete(synchronize_session=False)
+                db.session.commit()
+                time.sleep(pause)
+
+        while True:
+            orphans = db.session.query(ReplyContext.id)\
+                .filter(~sqlalchemy.exists().where(
+                    entry_to_context.c.context_id == ReplyContext.id))\
+                .limit(batch_size)\
+                .subquery()
+            count = ReplyContext.query\
+                .filter(ReplyContext.id.in_(orphans))\
+                .delete(synchronize_session=False)
+            db.session.commit()
+            removed['contexts'] += count
+            if count < batch_size:
+                break
+            time.sleep(pause)
+
+        removed['seconds'] = int(time.time() - started)
+        removed['finished'] = datetime.datetime.utcnow().isoformat()
+        current_app.logger.info(
+            'pruned %(entries)d entries, %(links)d reply context links and '
+            '%(contexts)d reply contexts in %(seconds)ds', removed)
+        redis.hmset('retention:last_run', removed)
+        return removed
+
+
+def prunable_entry_ids(feed_id, cutoff, keep, limit):
+    """Up to limit ids of a feed's entries that were retrieved before
+    the cutoff, or, once there are none of those, that are beyond the
+    newest keep.
+    """
+    query = db.session.query(Entry.id).filter(Entry.feed_id == feed_id)
+    entry_ids = [entry_id for entry_id, in query
+                 .filter(Entry.retrieved < cutoff)
+                 .limit(limit)]
+    if not entry_ids:
+        entry_ids = [entry_id for entry_id, in query
+                     .order_by(Entry.retrieved.desc(),
+                               Entry.published.desc(),
+                               Entry.id.desc())
+                     .offset(keep)
+                     .limit(limit)]
+    return entry_ids
+
+
+def rebuild_timeline(user_id):
+    with flask_app():
+        count = timeline.rebuild(user_id)
+        current_app.logger.info('Rebuilt timeline for user %d with %d entries',
+                                user_id, count)
+
+
+def insert_entries(feed, entries):
+    """Insert a feed's new entries in one statement, skipping any whose
+    uid the feed already has (e.g. stored by a concurrent update of the
+    same feed). Returns the inserted entries, loaded in one query, in
+    their original order.
+    """
+    if not entries:
+        return []
+
+    columns = [c for c in Entry.__table__.columns if c.name != 'id']
+    rows = []
+    for entry in entries:
+        entry.feed_id = feed.id
+        rows.append({c.name: getattr(entry, c.name) for c in columns})
+
+    table = Entry.__table__
+    stmt = sqlalchemy.dialects.postgresql.insert(table)\
+        .values(rows)\
+        .on_conflict_do_nothing(index_elements=['feed_id', 'uid'])\
+        .returning(table.c.id, table.c.uid)
+    ids = dict((uid, entry_id) for entry_id, uid in db.session.execute(stmt))
+    if not ids:
+        return []
+
+    stored = {e.uid: e for e in Entry.query.filter(Entry.id.in_(ids.values()))}
+    result = []
+    for entry in entries:
+        if entry.uid in stored:
+            result.append(stored.pop(entry.uid))
+    return result
+
+
 def check_push_subscription(feed, response):
     def send_request(mode, hub, topic):
         hub = urllib.parse.urljoin(feed.feed, hub)
@@ -255,7 +685,7 @@ def check_push_subscription(feed, response):
         current_app.logger.debug(
             'sending %s request for hub=%r, topic=%r, callback=%r',
             mode, hub, topic, callback)
-        r = requests.post(hub, data={
+        r = http_client.post(hub, data={
             'hub.mode': mode,
             'hub.topic': topic,
             'hub.callback': callback,
@@ -313,29 +743,61 @@ def check_push_subscription(feed, response):
             send_request('subscribe', hub, topic)
 
         db.session.commit()
+        # the PuSH endpoint caches secrets
+        redis.delete('push:secret:%d' % feed.id)
 
 
-def notify_feed_updated(app, feed_id, entries):
-    """Render the new entries and publish them to redis
+def notify_feed_updated(app, feed_id, entries, updated=False):
+    """Render the new entries and publish them to redis. Everything but the
+    subscription header and reply area is the same for every subscriber,
+    so it is rendered once per entry and the per-subscriber fragments are
+    filled in afterward. Updated entries replace their old rendering on
+    the page, instead of being shown as new.
     """
     from flask import render_template
-    import flask.ext.login as flask_login
     current_app.logger.debug('notifying feed updated: %s', feed_id)
 
-    feed = Feed.query.get(feed_id)
-    for s in feed.subscriptions:
-        with app.test_request_context():
-            flask_login.login_user(s.user, remember=True)
+    subscriptions = Subscription.query\
+        .filter(Subscription.feed_id == feed_id)\
+        .options(sqlalchemy.orm.joinedload(Subscription.user))\
+        .all()
+    if not subscriptions:
+        return
+    ReplyContext.load_for(entries)
+
+    with app.test_request_context():
+        bodies = []
+        for e in entries:
+            e.subscription = None
+            bodies.append(render_template(
+                '_entry.jinja2', entry=e, subscription_slot=SUBSCRIPTION_SLOT,
+                reply_slot=REPLY_SLOT))
+
+        # the reply area only depends on the entry and the user's settings
+        replies = {}
+        pipe = redis.pipeline(transaction=False)
+        for s in subscriptions:
+            header = render_template('_entry_subscription.jinja2',
+                                     subscription=s)
+            settings_key = (json.dumps(s.user.settings, sort_keys=True),
+                            bool(s.user.micropub_endpoint))
+
             rendered = []
-            for e in entries:
-                e.subscription = s
-                rendered.append(render_template('_entry.jinja2', entry=e))
+            for e, body in zip(entries, bodies):
+                reply_key = (e.id, settings_key)
+                if reply_key not in replies:
+                    replies[reply_key] = render_template(
+                        '_reply.jinja2', entry=e, current_user=s.user)
+                rendered.append(body
+                                .replace(SUBSCRIPTION_SLOT, header)
+                                .replace(REPLY_SLOT, replies[reply_key]))
 
             message = json.dumps({
                 'user': s.user.id,
-                'feed': feed.id,
+                'feed': feed_id,
                 'subscription': s.id,
                 'entries': rendered,
+                'updated': updated,
             })
 
             topics = []
@@ -344,13 +806,14 @@ def notify_feed_updated(app, feed_id, entries):
             topics.append('subsc:{}'.format(s.id))
 
             for topic in topics:
-                redis.publish('woodwind_notify:{}'.format(topic), message)
+                pipe.publish('woodwind_notify:{}'.format(topic), message)
+        pipe.execute()
 
 
-def is_content_equal(e1, e2):
-    """The criteria for determining if an entry that we've seen before
-    has been updated. If any of these fields have changed, we'll scrub the
-    old entry and replace it with the updated one.
+def content_fingerprint(entry):
+    """A hash of everything that decides whether a post we've seen before
+    has been updated. If it changes, we'll scrub the old entry and replace
+    it with the updated one.
     """
     def normalize(content):
         """Strip HTML tags, added to prevent a specific case where Wordpress
@@ -362,17 +825,22 @@ def is_content_equal(e1, e2):
             content = COMMENT_RE.sub('', content)
         return content
 
-    return (
-        e1.title == e2.title and
-        normalize(e1.content) == normalize(e2.content) and
-        e1.author_name == e2.author_name and
-        e1.author_url == e2.author_url and
-        e1.author_photo == e2.author_photo and
-        e1.properties == e2.properties and
-        e1.published == e2.published and
-        e1.updated == e2.updated and
-        e1.deleted == e2.deleted
-    )
+    def isoformat(dt):
+        return dt and dt.isoformat()
+
+    fields = [
+        entry.title,
+        normalize(entry.content),
+        entry.author_name,
+        entry.author_url,
+        entry.author_photo,
+        entry.properties,
+        isoformat(entry.published),
+        isoformat(entry.updated),
+        isoformat(entry.deleted),
+    ]
+    return hashlib.sha1(
+        json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()
 
 
 def process_xml_feed_for_new_entries(feed, content, backfill, now):
@@ -450,7 +918,6 @@ def process_xml_feed_for_new_entries(feed, content, backfill, now):
             retrieved=retrieved,
             title=p_entry.get('title'),
             content=content,
-            content_cleaned=util.clean(content),
             author_name=p_entry.get('author_detail', {}).get('name') or
             default_author_name,
             author_url=p_entry.get('author_detail', {}).get('href') or
@@ -549,7 +1016,6 @@ def hentry_to_entry(hentry, feed, backfill, now):
         deleted=deleted,
         title=title,
         content=content,
-        content_cleaned=util.clean(content),
         author_name=author_name,
         author_photo=author_photo or (feed and fallback_photo(feed.origin)),
         author_url=author_url)
@@ -587,35 +1053,197 @@ def hentry_to_entry(hentry, feed, backfill, now):
     return entry
 
 
-def fetch_reply_contexts(reply_pairs, now, fetch_mf2_func):
+def attach_reply_contexts(reply_pairs):
+    """Attach contexts we already have to new entries. Returns the
+    (entry id, url) pairs still to be fetched, with an entry id of None
+    for contexts that are only due for a refresh. Those are handed to
+    queue_reply_contexts after the entries are committed.
+    """
+    reply_pairs = [(entry, ReplyContext.normalize_permalink(url))
+                   for entry, url in reply_pairs]
     old_contexts = {}
-    in_reply_tos = [url for _, url in reply_pairs]
-    if in_reply_tos:
-        for entry in (Entry.query
-                      .join(Entry.feed)
-                      .filter(Entry.permalink.in_(in_reply_tos),
-                              Feed.type == 'html')):
-            old_contexts[entry.permalink] = entry
-
-    for entry, in_reply_to in reply_pairs:
-        context = old_contexts.get(in_reply_to)
-        if not context:
-            current_app.logger.info('fetching in-reply-to: %s', in_reply_to)
-            try:
-                proxied_reply_url = proxy_url(in_reply_to)
-                parsed = mf2util.interpret(
-                    mf2py.parse(url=proxied_reply_url), in_reply_to,
-                    fetch_mf2_func=fetch_mf2_func)
-                if parsed:
-                    context = hentry_to_entry(parsed, None, False, now)
-            except requests.exceptions.RequestException as err:
-                current_app.logger.warn(
-                    '%s fetching reply context: %s for entry: %s',
-                    type(err).__name__, proxied_reply_url, entry.permalink)
-
+    if reply_pairs:
+        for context in ReplyContext.query.filter(
+                ReplyContext.normalized_permalink.in_(
+                    [url for _, url in reply_pairs])):
+            old_contexts[context.normalized_permalink] = context
+
+    refresh_before = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=current_app.config.get('REPLY_CONTEXT_REFRESH',
+                                       REPLY_CONTEXT_REFRESH))
+    pending = []
+    for entry, url in reply_pairs:
+        context = old_contexts.get(url)
         if context:
-            db.session.add(context)
             entry.reply_context.append(context)
+            if not context.fetched or context.fetched < refresh_before:
+                pending.append((None, url))
+        else:
+            pending.append((entry.id, url))
+    return pending
+
+
+def queue_reply_contexts(pending):
+    """Queue up in-reply-to urls to be fetched by resolve_reply_contexts
+    in a job of their own, so that slow sites don't hold up the feed
+    update. The pending set dedupes urls across every feed being updated;
+    each url remembers which entries are waiting for it.
+    """
+    if not pending:
+        return
+    pipe = redis.pipeline()
+    for entry_id, url in pending:
+        if entry_id is not None:
+            pipe.sadd('replyctx:waiting:' + url, entry_id)
+        pipe.sadd('replyctx:pending', url)
+    pipe.execute()
+    if redis.set('replyctx:job', 1, ex=JOB_LOCK_TTL, nx=True):
+        enqueue_resolve_reply_contexts()
+
+
+def enqueue_resolve_reply_contexts():
+    q.enqueue_call(func=resolve_reply_contexts, timeout=DRAIN_JOB_TIMEOUT)
+
+
+def resolve_reply_contexts():
+    """Fetch pending in-reply-to urls concurrently, store (or refresh)
+    their contexts, attach them to the entries waiting for them, and push
+    those entries out to anyone watching. Handles a bounded number of
+    batches, then hands off to a new job if there are more.
+    """
+    with flask_app() as app:
+        started = time.time()
+        try:
+            for _ in range(DRAIN_JOB_BATCHES):
+                if time.time() - started > REPLY_CONTEXT_JOB_BUDGET:
+                    break
+                urls = [url.decode() for url in redis.srandmember(
+                    'replyctx:pending', REPLY_CONTEXT_BATCH)]
+                if not urls:
+                    break
+                redis.expire('replyctx:job', JOB_LOCK_TTL)
+                resolve_reply_context_batch(app, urls)
+        except:
+            # leave the urls pending, and let the next update start a
+            # new job
+            redis.delete('replyctx:job')
+            raise
+
+        if not release_job_if_idle('replyctx:job', 'replyctx:pending'):
+            redis.expire('replyctx:job', JOB_LOCK_TTL)
+            enqueue_resolve_reply_contexts()
+
+
+def resolve_reply_context_batch(app, urls):
+    current_app.logger.info('fetching %d reply contexts', len(urls))
+    responses = fetcher.fetch_all(
+        {url: proxy_url(url) for url in urls},
+        per_host=app.config.get('FETCH_PER_HOST', fetcher.PER_HOST),
+        max_size=get_fetch_limits()[0])
+
+    old_contexts = {
+        context.normalized_permalink: context
+        for context in ReplyContext.query.filter(
+            ReplyContext.normalized_permalink.in_(urls))}
+
+    pipe = redis.pipeline(transaction=False)
+    for url in urls:
+        pipe.smembers('replyctx:waiting:' + url)
+    waiting = dict(zip(urls, pipe.execute()))
+
+    now = datetime.datetime.utcnow()
+    updated = []
+    for url in urls:
+        try:
+            context = update_reply_context(
+                url, old_contexts.get(url), responses[url], now)
+        except Exception:
+            # a page we can't parse is given up on, like one we can't
+            # fetch, rather than retried forever
+            current_app.logger.exception(
+                'error parsing reply context: %s', url)
+            continue
+        entry_ids = [int(i) for i in waiting[url]]
+        if context and entry_ids:
+            for entry in Entry.query.filter(Entry.id.in_(entry_ids)):
+                entry.reply_context.append(context)
+                updated.append(entry)
+    db.session.commit()
+
+    # done with these urls, unless more entries started waiting for
+    # them in the meantime
+    pipe = redis.pipeline(transaction=False)
+    for url in urls:
+        if waiting[url]:
+            pipe.srem('replyctx:waiting:' + url, *waiting[url])
+        pipe.srem('replyctx:pending', url)
+    pipe.execute()
+    pipe = redis.pipeline(transaction=False)
+    for url in urls:
+        pipe.exists('replyctx:waiting:' + url)
+    still_waiting = pipe.execute()
+    pipe = redis.pipeline(transaction=False)
+    for url, waiting_again in zip(urls, still_waiting):
+        if waiting_again:
+            pipe.sadd('replyctx:pending', url)
+    pipe.execute()
+
+    by_feed = {}
+    for entry in updated:
+        if entry.feed_id:
+            by_feed.setdefault(entry.feed_id, []).append(entry)
+    for feed_id, entries in by_feed.items():
+        notify_feed_updated(app, feed_id, entries, updated=True)
+
+
+def update_reply_context(url, context, response, now):
+    """Parse a fetched in-reply-to post into its ReplyContext, creating
+    one if this is the first time we've seen it. A failed fetch leaves
+    the old context, if any, alone.
+    """
+    if not isinstance(response, requests.Response):
+        current_app.logger.warn('%s fetching reply context: %s',
+                                type(response).__name__, url)
+        return context
+    if response.status_code // 100 != 2:
+        current_app.logger.warn('bad response fetching reply context: %s %r',
+                                url, response)
+        return context
+
+    parsed = mf2util.interpret(
+        mf2py.parse(doc=get_response_content(response), url=response.url),
+        url, fetch_mf2_func=mf2cache.fetch_mf2)
+    entry = parsed and hentry_to_entry(parsed, None, False, now)
+    if not entry:
+        return context
+
+    if not context:
+        context = ReplyContext(normalized_permalink=url)
+        db.session.add(context)
+    for attr in ('permalink', 'published', 'author_name', 'author_url',
+                 'author_photo', 'title', 'content'):
+        setattr(context, attr, getattr(entry, attr))
+    context.permalink = context.permalink or url
+    context.content_cleaned = util.clean(context.content)
+    context.fetched = now
+    return context
+
+
+def release_job_if_idle(job_key, queue_key):
+    """Let go of a job's lock once its queue is empty. Returns False if
+    more work arrived in the meantime, and the job should keep going.
+    """
+    with redis.pipeline() as pipe:
+        try:
+            pipe.watch(queue_key)
+            if pipe.exists(queue_key):
+                return False
+            pipe.multi()
+            pipe.delete(job_key)
+            pipe.execute()
+            return True
+        except WatchError:
+            return False
 
 
 def proxy_url(url):
@@ -0,0 +1,218 @@
+"""Optional precomputed home timelines, kept as a capped redis sorted set
+of entry ids per user. update_feed pushes new entries onto the timelines
+of everyone subscribed, and the index page reads a page of ids back and
+loads those entries in one query. Turn it on with TIMELINE_CACHE.
+
+Next to each timeline is a sorted set of the syndication urls of its
+entries, so that syndicated copies can be hidden even when the original
+is on another page.
+"""
+from flask import current_app
+from redis import StrictRedis, WatchError
+from woodwind.extensions import db
+from woodwind.models import Entry, Feed, Subscription
+import calendar
+import uuid
+
+redis = StrictRedis()
+
+# default number of entries kept in each user's timeline
+TIMELINE_DEPTH = 1000
+# seconds before an unfinished rebuild (a killed worker, say) stops
+# receiving new entries
+BUILDING_TTL = 300
+
+
+def is_enabled():
+    return current_app.config.get('TIMELINE_CACHE', False)
+
+
+def get_depth():
+    return current_app.config.get('TIMELINE_DEPTH', TIMELINE_DEPTH)
+
+
+def timeline_key(user_id):
+    return 'timeline:user:{}'.format(user_id)
+
+
+def syndication_key(user_id):
+    return 'timeline:synd:{}'.format(user_id)
+
+
+def built_key(user_id):
+    # empty sorted sets don't exist in redis, so keep track separately of
+    # whether a timeline has been built
+    return 'timeline:built:{}'.format(user_id)
+
+
+def building_key(user_id):
+    # set while a rebuild is querying, so that entries committed in the
+    # meantime are still pushed onto the timeline
+    return 'timeline:building:{}'.format(user_id)
+
+
+def score(entry):
+    return score_for(entry.retrieved)
+
+
+def score_for(retrieved):
+    return (calendar.timegm(retrieved.utctimetuple())
+            + retrieved.microsecond / 1e6)
+
+
+def member(entry_id):
+    # zero-padded, so that entries retrieved at the same moment come
+    # back newest id first
+    return '{:012d}'.format(entry_id)
+
+
+def push_entries(feed_id, entries, replaced_ids=()):
+    """Add new entries from a feed to the timelines of every user who
+    subscribes to it, replacing old versions of updated entries.
+    Timelines that have not been built, and aren't being rebuilt, are
+    left alone.
+    """
+    if not is_enabled() or not (entries or replaced_ids):
+        return
+
+    user_ids = [user_id for user_id, in db.session.query(Subscription.user_id)
+                .filter(Subscription.feed_id == feed_id,
+                        Subscription.exclude == False)]
+
+    pipe = redis.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.exists(built_key(user_id))
+        pipe.exists(building_key(user_id))
+    found = pipe.execute()
+    built = [a or b for a, b in zip(found[::2], found[1::2])]
+
+    depth = get_depth()
+    pairs = []
+    syndication_pairs = []
+    for entry in entries:
+        pairs += [score(entry), member(entry.id)]
+        syndication_pairs += syndication_scores(
+            entry.retrieved, entry.get_property('syndication'))
+
+    pipe = redis.pipeline(transaction=False)
+    for user_id, is_built in zip(user_ids, built):
+        if not is_built:
+            continue
+        key = timeline_key(user_id)
+        if replaced_ids:
+            pipe.zrem(key, *[member(i) for i in replaced_ids])
+        if pairs:
+            pipe.zadd(key, *pairs)
+        pipe.zremrangebyrank(key, 0, -depth - 1)
+        if syndication_pairs:
+            pipe.zadd(syndication_key(user_id), *syndication_pairs)
+            pipe.zremrangebyrank(syndication_key(user_id), 0, -depth - 1)
+    pipe.execute()
+
+
+def syndication_scores(retrieved, syndication):
+    pairs = []
+    if isinstance(syndication, list):
+        for url in syndication:
+            if isinstance(url, str):
+                pairs += [score_for(retrieved), url]
+    return pairs
+
+
+def read_page(user_id, before_id, count):
+    """Returns the ids of the next count entries in a user's timeline,
+    after the entry before_id if given. Returns None if the timeline
+    has not been built, no longer contains before_id, or has been trimmed
+    and runs out before count entries (older entries are still in the
+    database).
+    """
+    key = timeline_key(user_id)
+    if not redis.exists(built_key(user_id)):
+        return None
+
+    start = 0
+    if before_id:
+        rank = redis.zrevrank(key, member(before_id))
+        if rank is None:
+            return None
+        start = rank + 1
+
+    ids = [int(m) for m in redis.zrevrange(key, start, start + count - 1)]
+    if len(ids) < count and redis.zcard(key) >= get_depth():
+        return None
+    return ids
+
+
+def find_copies(user_id, permalinks):
+    """Returns the permalinks that are syndicated copies of entries in a
+    user's timeline, checking them all in one round trip.
+    """
+    permalinks = [p for p in permalinks if p]
+    pipe = redis.pipeline(transaction=False)
+    for permalink in permalinks:
+        pipe.zscore(syndication_key(user_id), permalink)
+    return {permalink for permalink, found
+            in zip(permalinks, pipe.execute()) if found is not None}
+
+
+def invalidate(user_id):
+    """Throw away a user's timeline after their subscriptions change. It
+    is rebuilt the next time they load the index page.
+    """
+    redis.delete(timeline_key(user_id), syndication_key(user_id),
+                 built_key(user_id), building_key(user_id))
+
+
+def rebuild(user_id):
+    """Rebuild a user's timeline from the database. The old timeline is
+    cleared and marked as building before the query, so that entries
+    committed while it runs are pushed onto the new one by push_entries
+    rather than missed. If the timeline is invalidated (or the rebuild
+    outlives BUILDING_TTL) meanwhile, it is left unbuilt for the next
+    page load to rebuild.
+    """
+    key = timeline_key(user_id)
+    token = uuid.uuid4().hex
+    pipe = redis.pipeline()
+    pipe.delete(key, syndication_key(user_id), built_key(user_id))
+    pipe.set(building_key(user_id), token, ex=BUILDING_TTL)
+    pipe.execute()
+
+    now = db.func.now()
+    rows = db.session.query(Entry.id, Entry.retrieved,
+                            Entry.properties['syndication'])\
+        .join(Entry.feed)\
+        .join(Feed.subscriptions)\
+        .filter(Subscription.user_id == user_id,
+                Subscription.exclude == False)\
+        .filter(db.or_(Entry.deleted == None, Entry.deleted >= now))\
+        .order_by(Entry.retrieved.desc(), Entry.published.desc(),
+                  Entry.id.desc())\
+        .limit(get_depth())\
+        .all()
+
+    with redis.pipeline() as pipe:
+        try:
+            pipe.watch(building_key(user_id))
+            if pipe.get(building_key(user_id)) != token.encode():
+                return 0
+            pipe.multi()
+            for ii in range(0, len(rows), 500):
+                pairs = []
+                syndication_pairs = []
+                for entry_id, retrieved, syndication in rows[ii:ii + 500]:
+                    pairs += [score_for(retrieved), member(entry_id)]
+                    syndication_pairs += syndication_scores(
+                        retrieved, syndication)
+                pipe.zadd(key, *pairs)
+                if syndication_pairs:
+                    pipe.zadd(syndication_key(user_id), *syndication_pairs)
+            depth = get_depth()
+            pipe.zremrangebyrank(key, 0, -depth - 1)
+            pipe.zremrangebyrank(syndication_key(user_id), 0, -depth - 1)
+            pipe.set(built_key(user_id), 1)
+            pipe.delete(building_key(user_id))
+            pipe.execute()
+        except WatchError:
+            return 0
+    return len(rows)
@@ -1,14 +1,14 @@
-import pickle
+import hashlib
+import html
+import html.parser
 import re
 from xml.sax import saxutils
 
-from flask import current_app
-from redis import StrictRedis
+from flask import current_app, has_app_context
+from woodwind import cache, http_client
 import bleach
 import requests
 
-redis = StrictRedis()
-
 bleach.ALLOWED_TAGS += [
     'a', 'img', 'p', 'br', 'marquee', 'blink',
     'audio', 'video', 'source', 'table', 'tbody', 'td', 'tr', 'div', 'span',
@@ -23,43 +23,272 @@ bleach.ALLOWED_ATTRIBUTES.update({
     'td': ['colspan'],
 })
 
-USER_AGENT = 'Woodwind (https://github.com/kylewm/woodwind)'
+USER_AGENT = http_client.USER_AGENT
 
+# cleaned content is cached by a hash of the original, first in process
+# and then in redis
+CLEAN_CACHE_SIZE = 10000
+CLEAN_CACHE_TTL = 7 * 24 * 3600
+clean_cache = None
 
-def requests_get(url, **kwargs):
-    lastresp = redis.get('resp:' + url)
-    if lastresp:
-        lastresp = pickle.loads(lastresp)
+# closing tags of RSS items and Atom entries, to count them as they
+# stream in
+ITEM_END_RE = re.compile(rb'</(?:\w+:)?(?:item|entry)\s*>', re.IGNORECASE)
+CHUNK_SIZE = 64 * 1024
+
+
+class ResponseTooLarge(requests.exceptions.RequestException):
+    pass
+
+
+class BodyReader:
+    """Collects a response body as it streams in. Raises ResponseTooLarge
+    once it grows past max_size, and when max_items is given, stops
+    reading (and cuts off the body) after that many feed items, so we
+    never hold more than the first items of an enormous feed. truncated
+    says whether it did.
+    """
+    def __init__(self, url, max_size, max_items=None):
+        self.url = url
+        self.max_size = max_size
+        self.max_items = max_items
+        self.buffer = bytearray()
+        self.items = 0
+        self.scan_from = 0
+        self.truncated = False
 
+    def feed(self, chunk):
+        """Add a chunk of the body. Returns True once there is no need to
+        read any more of it.
+        """
+        self.buffer += chunk
+        if len(self.buffer) > self.max_size:
+            raise ResponseTooLarge('{} is larger than {} bytes'.format(
+                self.url, self.max_size))
+
+        if self.max_items:
+            for match in ITEM_END_RE.finditer(self.buffer, self.scan_from):
+                self.items += 1
+                self.scan_from = match.end()
+                if self.items >= self.max_items:
+                    break
+            if self.items >= self.max_items:
+                # feedparser copes with the document being unclosed
+                self.truncated = len(self.buffer) > self.scan_from
+                del self.buffer[self.scan_from:]
+                return True
+            # a closing tag may be split across chunks
+            self.scan_from = max(self.scan_from, len(self.buffer) - 32)
+        return False
+
+    @property
+    def content(self):
+        return bytes(self.buffer)
+
+
+def requests_get(url, max_size=None, max_items=None, **kwargs):
+    lastresp = get_cached_response(url)
     headers = kwargs.setdefault('headers', {})
     headers['User-Agent'] = USER_AGENT
+    add_conditional_headers(headers, lastresp)
 
+    if 'timeout' not in kwargs:
+        kwargs['timeout'] = http_client.TIMEOUT
+    if max_size:
+        kwargs['stream'] = True
+
+    current_app.logger.debug('fetching %s with args %s', url, kwargs)
+    # hold the host's slot until a streamed body has been read too
+    with http_client.host_slot(url):
+        resp = http_client.get_session().get(url, **kwargs)
+        if max_size and resp.status_code // 100 == 2:
+            read_limited(resp, max_size, max_items)
+
+    current_app.logger.debug('fetching %s got response %s', url, resp)
+    return finish_response(url, resp, lastresp)
+
+
+def read_limited(resp, max_size, max_items=None):
+    """Read a streamed response's body through a BodyReader, noting on
+    the response whether the body was cut off.
+    """
+    reader = BodyReader(resp.url, max_size, max_items)
+    try:
+        if int(resp.headers.get('Content-Length') or 0) > max_size:
+            raise ResponseTooLarge('{} is larger than {} bytes'.format(
+                resp.url, max_size))
+        for chunk in resp.iter_content(CHUNK_SIZE):
+            if reader.feed(chunk):
+                break
+    finally:
+        resp.close()
+    resp._content = reader.content
+    resp._content_consumed = True
+    resp.truncated = reader.truncated
+
+
+def get_cached_response(url):
+    """Look up the last successful response for a url, if we have one.
+    """
+    cached = cache.get_response(url)
+    if cached:
+        return build_response(cached.url, cached.status_code,
+                              cached.headers, cached.content)
+
+
+def add_conditional_headers(headers, lastresp):
     if lastresp:
         if 'Etag' in lastresp.headers:
             headers['If-None-Match'] = lastresp.headers['Etag']
         if 'Last-Modified' in lastresp.headers:
             headers['If-Modified-Since'] = lastresp.headers['Last-Modified']
 
-    if 'timeout' not in kwargs:
-        kwargs['timeout'] = (9.1, 30)
-
-    current_app.logger.debug('fetching %s with args %s', url, kwargs)
-    resp = requests.get(url, **kwargs)
 
-    current_app.logger.debug('fetching %s got response %s', url, resp)
-    if resp.status_code == 304:
+def finish_response(url, resp, lastresp):
+    """Replay the cached response when the server says it has not
+    changed, and remember successful responses for next time.
+    """
+    if resp.status_code == 304 and lastresp:
+        cache.redis.hincrby('respcache:stats', 'not_modified', 1)
         return lastresp
     if resp.status_code // 100 == 2:
-        redis.setex('resp:' + url, 24 * 3600, pickle.dumps(resp))
+        cache.set_response(url, resp)
     return resp
 
 
+def build_response(url, status_code, headers, content):
+    """Wrap a response fetched by some other http client in a
+    requests.Response, so that it can be handled like any other.
+    """
+    resp = requests.Response()
+    resp.url = url
+    resp.status_code = status_code
+    resp.headers = requests.structures.CaseInsensitiveDict(headers)
+    resp.encoding = requests.utils.get_encoding_from_headers(resp.headers)
+    resp._content = content
+    return resp
+
+
+def get_clean_cache():
+    global clean_cache
+    if clean_cache is None:
+        size = CLEAN_CACHE_SIZE
+        if has_app_context():
+            size = current_app.config.get('CLEAN_CACHE_SIZE', size)
+        clean_cache = cache.LRUCache(size)
+    return clean_cache
+
+
 def clean(text):
-    """Strip script tags and other possibly dangerous content
+    """Strip script tags and other possibly dangerous content. Results are
+    cached, since the same content is seen over and over.
     """
-    if text is not None:
-        text = re.sub('<script.*?</script>', '', text, flags=re.DOTALL)
-        return bleach.clean(text, strip=True)
+    if text is None:
+        return None
+
+    sanitizer = get_sanitizer()
+    key = 'clean:{}:{}'.format(
+        sanitizer, hashlib.sha1(text.encode('utf-8')).hexdigest())
+    local = get_clean_cache()
+    cleaned = local.get(key)
+    if cleaned is None:
+        cleaned = cache.redis.get(key)
+        if cleaned is not None:
+            cleaned = cleaned.decode('utf-8')
+            cache.redis.hincrby('cleancache:stats', 'hits', 1)
+        else:
+            cleaned = SANITIZERS[sanitizer](text)
+            pipe = cache.redis.pipeline(transaction=False)
+            pipe.setex(key, CLEAN_CACHE_TTL, cleaned)
+            pipe.hincrby('cleancache:stats', 'misses', 1)
+            pipe.execute()
+        local.set(key, cleaned)
+    return cleaned
+
+
+def get_sanitizer():
+    if has_app_context():
+        return current_app.config.get('SANITIZER', 'bleach')
+    return 'bleach'
+
+
+def bleach_clean(text):
+    text = re.sub('<script.*?</script>', '', text, flags=re.DOTALL)
+    return bleach.clean(text, strip=True)
+
+
+def allowlist_clean(text):
+    parser = AllowlistSanitizer()
+    parser.feed(text)
+    parser.close()
+    return ''.join(parser.output)
+
+
+class AllowlistSanitizer(html.parser.HTMLParser):
+    """A faster alternative to bleach that allows the same tags, attributes,
+    and url protocols. It streams through the markup with the standard
+    library's tokenizer instead of building an html5lib tree, so unlike
+    bleach it does not balance unclosed tags.
+    """
+    # everything inside these is dropped, not just the tags themselves
+    DROP_CONTENT = ('script', 'style')
+    URL_ATTRIBUTES = ('href', 'src', 'poster', 'action', 'background',
+                      'cite', 'longdesc')
+    VOID_TAGS = ('br', 'img', 'source', 'hr')
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.output = []
+        self.dropping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.DROP_CONTENT:
+            self.dropping += 1
+        elif not self.dropping and tag in bleach.ALLOWED_TAGS:
+            self.output.append(self.render_starttag(tag, attrs))
+
+    def handle_startendtag(self, tag, attrs):
+        if not self.dropping and tag in bleach.ALLOWED_TAGS:
+            self.output.append(self.render_starttag(tag, attrs))
+            if tag not in self.VOID_TAGS:
+                self.output.append('</{}>'.format(tag))
+
+    def handle_endtag(self, tag):
+        if tag in self.DROP_CONTENT:
+            self.dropping = max(self.dropping - 1, 0)
+        elif (not self.dropping and tag in bleach.ALLOWED_TAGS
+                and tag not in self.VOID_TAGS):
+            self.output.append('</{}>'.format(tag))
+
+    def handle_data(self, data):
+        if not self.dropping:
+            self.output.append(html.escape(data, quote=False))
+
+    def render_starttag(self, tag, attrs):
+        allowed = (bleach.ALLOWED_ATTRIBUTES.get(tag, [])
+                   + bleach.ALLOWED_ATTRIBUTES.get('*', []))
+        parts = [tag]
+        for name, value in attrs:
+            if name not in allowed:
+                continue
+            value = value or ''
+            if name in self.URL_ATTRIBUTES and not self.is_safe_url(value):
+                continue
+            parts.append('{}="{}"'.format(name, html.escape(value)))
+        return '<{}>'.format(' '.join(parts))
+
+    @staticmethod
+    def is_safe_url(url):
+        # browsers ignore whitespace and control characters in schemes
+        url = re.sub(r'[\s\x00-\x1f]+', '', url).lower()
+        scheme = re.match(r'([^/?#]*?):', url)
+        return not scheme or scheme.group(1) in bleach.ALLOWED_PROTOCOLS
+
+
+SANITIZERS = {
+    'bleach': bleach_clean,
+    'allowlist': allowlist_clean,
+}
 
 
 def html_escape(text):
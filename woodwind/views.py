@@ -1,6 +1,7 @@
-from . import tasks, util
+from . import fragments, search, tasks, timeline, util
 from .extensions import db, login_mgr, micropub
-from .models import Feed, Entry, User, Subscription
+from .models import Feed, Entry, ReplyContext, User, Subscription, \
+    SubscriptionTag
 import flask.ext.login as flask_login
 
 import base64
@@ -10,6 +11,7 @@ import feedparser
 import flask
 import hashlib
 import hmac
+import json
 import mf2py
 import mf2util
 import pyquerystring
@@ -17,9 +19,10 @@ import requests
 import re
 import urllib
 import sqlalchemy
-import sqlalchemy.sql.expression
 
 IMAGE_TAG_RE = re.compile(r'<img([^>]*) src="(https?://[^">]+)"')
+# seconds to cache each user's set of tags
+USER_TAGS_TTL = 24 * 60 * 60
 
 
 views = flask.Blueprint('views', __name__)
@@ -32,31 +35,28 @@ def offline():
 @views.route('/')
 def index():
     page = int(flask.request.args.get('page', 1))
+    cursor = decode_cursor(flask.request.args.get('before'))
+    next_cursor = None
     entry_tups = []
     ws_topic = None
     solo = False
     all_tags = set()
+    known_copies = set()
     now = datetime.datetime.now()
 
     if flask_login.current_user.is_authenticated:
-        for subsc in flask_login.current_user.subscriptions:
-            if subsc.tags:
-                all_tags.update(subsc.tags.split())
+        all_tags = get_user_tags(flask_login.current_user.id)
 
         per_page = flask.current_app.config.get('PER_PAGE', 30)
         offset = (page - 1) * per_page
 
         entry_query = db.session.query(Entry, Subscription)\
-            .options(
-                sqlalchemy.orm.subqueryload(Entry.feed),
-                sqlalchemy.orm.subqueryload(Entry.reply_context))\
+            .options(sqlalchemy.orm.subqueryload(Entry.feed))\
             .join(Entry.feed)\
             .join(Feed.subscriptions)\
-            .join(Subscription.user)\
-            .filter(User.id == flask_login.current_user.id)\
+            .filter(Subscription.user_id == flask_login.current_user.id)\
             .filter(db.or_(Entry.deleted == None,
-                           Entry.deleted >= now))\
-            .order_by(Entry.published.desc())
+                           Entry.deleted >= now))
 
         if 'entry' in flask.request.args:
             entry_url = flask.request.args.get('entry')
@@ -70,8 +70,10 @@ def index():
         else:
             if 'tag' in flask.request.args:
                 tag = flask.request.args.get('tag')
-                entry_query = entry_query.filter(
-                    Subscription.tags.like('%{}%'.format(tag)))
+                entry_query = entry_query\
+                    .join(SubscriptionTag,
+                          SubscriptionTag.subscription_id == Subscription.id)\
+                    .filter(SubscriptionTag.tag == tag)
             elif 'subscription' in flask.request.args:
                 subsc_id = flask.request.args.get('subscription')
                 subsc = Subscription.query.get(subsc_id)
@@ -80,16 +82,47 @@ def index():
                 entry_query = entry_query.filter(Subscription.id == subsc_id)
                 ws_topic = 'subsc:{}'.format(subsc.id)
             elif 'jam' in flask.request.args:
+                entry_query = entry_query.filter(Entry.is_jam == True)
+            elif 'event' in flask.request.args:
+                entry_query = entry_query.filter(Entry.is_event == True)
+            elif 'noreplies' in flask.request.args:
                 entry_query = entry_query.filter(
-                    sqlalchemy.sql.expression.cast(Entry.properties['jam'], sqlalchemy.TEXT) == 'true')
+                    Subscription.exclude == False,
+                    Entry.is_reply == False,
+                    Entry.is_like == False,
+                    Entry.is_repost == False)
             else:
                 entry_query = entry_query.filter(Subscription.exclude == False)
                 ws_topic = 'user:{}'.format(flask_login.current_user.id)
 
-            entry_query = entry_query.order_by(Entry.retrieved.desc(),
-                                               Entry.published.desc())\
-                                     .offset(offset).limit(per_page)
-            entry_tups = entry_query.all()
+            timeline_tups = None
+            if ws_topic == 'user:{}'.format(flask_login.current_user.id):
+                timeline_tups = read_timeline_entries(
+                    entry_query, cursor, page, per_page)
+
+            if timeline_tups is not None:
+                entry_tups = timeline_tups
+                # hide copies whose originals are on other pages too
+                known_copies = timeline.find_copies(
+                    flask_login.current_user.id,
+                    [entry.permalink for entry, _ in entry_tups])
+            else:
+                # page with a cursor from the last entry on the previous
+                # page when we have one, so deep pages don't need a big
+                # OFFSET
+                if cursor:
+                    entry_query = entry_query.filter(before_cursor(*cursor))
+                else:
+                    entry_query = entry_query.offset(offset)
+
+                entry_query = entry_query.order_by(Entry.retrieved.desc(),
+                                                   Entry.published.desc(),
+                                                   Entry.id.desc())\
+                                         .limit(per_page)
+                entry_tups = entry_query.all()
+
+            if entry_tups:
+                next_cursor = encode_cursor(entry_tups[-1][0])
 
     # stick the subscription into the entry.
     # FIXME this is hacky
@@ -98,15 +131,163 @@ def index():
         entry.subscription = subsc
         entries.append(entry)
 
-    entries = dedupe_copies(entries)
+    entries = dedupe_copies(entries, known_copies)
+    ReplyContext.load_for(entries)
     resp = flask.make_response(
         flask.render_template('feed.jinja2', entries=entries, page=page,
+                              rendered_entries=render_entries(entries),
+                              next_cursor=next_cursor,
                               ws_topic=ws_topic, solo=solo,
                               all_tags=all_tags))
     resp.headers['Cache-control'] = 'max-age=0'
     return resp
 
 
+@views.route('/search')
+@flask_login.login_required
+def search_entries():
+    text = flask.request.args.get('q', '').strip()
+    page = int(flask.request.args.get('page', 1))
+    per_page = flask.current_app.config.get('PER_PAGE', 30)
+
+    entries = []
+    if text:
+        for entry, subsc in search.search(
+                flask_login.current_user.id, text, page, per_page):
+            entry.subscription = subsc
+            entries.append(entry)
+        ReplyContext.load_for(entries)
+
+    resp = flask.make_response(
+        flask.render_template('feed.jinja2', entries=entries, page=page,
+                              rendered_entries=render_entries(entries),
+                              next_cursor=None, search_text=text,
+                              all_tags=get_user_tags(
+                                  flask_login.current_user.id)))
+    resp.headers['Cache-control'] = 'max-age=0'
+    return resp
+
+
+def get_user_tags(user_id):
+    """All the tags on a user's subscriptions, cached in redis until
+    they edit one.
+    """
+    key = 'tags:user:{}'.format(user_id)
+    cached = tasks.redis.get(key)
+    if cached is not None:
+        return set(json.loads(cached.decode()))
+
+    tags = {tag for tag, in db.session.query(SubscriptionTag.tag)
+            .join(Subscription,
+                  Subscription.id == SubscriptionTag.subscription_id)
+            .filter(Subscription.user_id == user_id)
+            .distinct()}
+    tasks.redis.setex(key, USER_TAGS_TTL, json.dumps(sorted(tags)))
+    return tags
+
+
+def invalidate_user_tags(user_id):
+    tasks.redis.delete('tags:user:{}'.format(user_id))
+
+
+def read_timeline_page(cursor, page, per_page):
+    """Read a page of entry ids from the current user's precomputed
+    timeline. Returns None when the timeline can't answer, and the index
+    should be queried directly instead.
+    """
+    if not timeline.is_enabled() or (page > 1 and not cursor):
+        return None
+
+    user_id = flask_login.current_user.id
+    entry_ids = timeline.read_page(
+        user_id, cursor and cursor[2], per_page)
+    if entry_ids is None and not cursor:
+        # only ask for one rebuild at a time
+        if tasks.redis.set('timeline:rebuilding:{}'.format(user_id), 1,
+                           ex=300, nx=True):
+            tasks.q_high.enqueue(tasks.rebuild_timeline, user_id)
+    return entry_ids
+
+
+def read_timeline_entries(entry_query, cursor, page, per_page):
+    """Load a page of entries from the current user's precomputed
+    timeline. Ids that no longer load (pruned or deleted entries) are
+    made up for with the ids after them, so the page isn't cut short.
+    Returns None when the index should be queried directly instead.
+    """
+    entry_ids = read_timeline_page(cursor, page, per_page)
+    if entry_ids is None:
+        return None
+
+    entry_tups = []
+    while entry_ids:
+        positions = {entry_id: ii for ii, entry_id in enumerate(entry_ids)}
+        tups = entry_query.filter(Entry.id.in_(entry_ids)).all()
+        tups.sort(key=lambda tup: positions[tup[0].id])
+        entry_tups += tups
+        if len(entry_tups) >= per_page:
+            break
+        entry_ids = timeline.read_page(
+            flask_login.current_user.id, entry_ids[-1],
+            per_page - len(entry_tups))
+
+    if entry_ids is None and not entry_tups:
+        # the timeline ran out (trimmed) before anything loaded
+        return None
+    return entry_tups
+
+
+CURSOR_DATETIME_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def encode_cursor(entry):
+    """Make an opaque token for the position of an entry in a timeline
+    ordered by (retrieved, published, id).
+    """
+    def fmt(dt):
+        return dt.strftime(CURSOR_DATETIME_FORMAT) if dt else ''
+
+    token = '{}|{}|{}'.format(
+        fmt(entry.retrieved), fmt(entry.published), entry.id)
+    return base64.urlsafe_b64encode(token.encode()).decode()
+
+
+def decode_cursor(token):
+    """Returns a (retrieved, published, id) tuple, or None if the token
+    is missing or malformed.
+    """
+    def parse(value):
+        if value:
+            return datetime.datetime.strptime(value, CURSOR_DATETIME_FORMAT)
+
+    if not token:
+        return None
+    try:
+        retrieved, published, entry_id = base64.urlsafe_b64decode(
+            token.encode()).decode().split('|')
+        return parse(retrieved), parse(published), int(entry_id)
+    except (ValueError, TypeError):
+        return None
+
+
+def before_cursor(retrieved, published, entry_id):
+    """Filter for entries that come after the cursor in a timeline ordered
+    by (retrieved, published, id) descending. Spelled out instead of using
+    a row comparison, because published may be NULL (which sorts first).
+    """
+    if published is None:
+        same_retrieved = db.or_(Entry.published != None,
+                                Entry.id < entry_id)
+    else:
+        same_retrieved = db.or_(
+            Entry.published < published,
+            db.and_(Entry.published == published, Entry.id < entry_id))
+
+    return db.and_(
+        Entry.retrieved <= retrieved,
+        db.or_(Entry.retrieved < retrieved, same_retrieved))
+
+
 @views.route('/install')
 def install():
     db.create_all()
@@ -232,6 +413,8 @@ def unsubscribe():
     subsc = Subscription.query.get(subsc_id)
     db.session.delete(subsc)
     db.session.commit()
+    timeline.invalidate(flask_login.current_user.id)
+    invalidate_user_tags(flask_login.current_user.id)
     flask.flash('Unsubscribed {}'.format(subsc.name))
     return flask.redirect(flask.url_for('.subscriptions'))
 
@@ -246,14 +429,12 @@ def edit_subscription():
     subsc = Subscription.query.get(subsc_id)
     if subsc_name:
         subsc.name = subsc_name
-    if subsc_tags:
-        tag_list = re.split(r'(?:\s|,)+', subsc_tags)
-        subsc.tags = ' '.join(t.strip() for t in tag_list if t.strip())
-    else:
-        subsc.tags = None
+    subsc.set_tags(re.split(r'(?:\s|,)+', subsc_tags or ''))
     subsc.exclude = flask.request.form.get('exclude') == 'true'
 
     db.session.commit()
+    timeline.invalidate(flask_login.current_user.id)
+    invalidate_user_tags(flask_login.current_user.id)
     flask.flash('Edited {}'.format(subsc.name))
     return flask.redirect(flask.url_for('.subscriptions'))
 
@@ -462,7 +643,11 @@ def add_subscription(origin, feed_url, type, tags=None):
             name = parsed.get('name')
         elif type == 'xml':
             flask.current_app.logger.debug('feedparser parsing %s', feed_url)
-            parsed = feedparser.parse(feed_url, agent=util.USER_AGENT)
+            resp = util.requests_get(feed_url)
+            parsed = feedparser.parse(resp.content, response_headers={
+                'content-location': feed_url,
+                'content-type': resp.headers.get('content-type', ''),
+            })
             if parsed.feed:
                 name = parsed.feed.get('title')
         else:
@@ -477,10 +662,13 @@ def add_subscription(origin, feed_url, type, tags=None):
     if feed:
         db.session.add(feed)
 
-        flask_login.current_user.subscriptions.append(
-            Subscription(feed=feed, name=feed.name, tags=tags))
+        subsc = Subscription(feed=feed, name=feed.name)
+        subsc.set_tags((tags or '').split())
+        flask_login.current_user.subscriptions.append(subsc)
 
         db.session.commit()
+        timeline.invalidate(flask_login.current_user.id)
+        invalidate_user_tags(flask_login.current_user.id)
         # go ahead and update the fed
         tasks.q.enqueue(tasks.update_feed, feed.id)
     return feed
@@ -744,26 +932,68 @@ def proxy_all(content):
         return IMAGE_TAG_RE.sub(repl, content)
 
 
+def render_entries(entries):
+    """Render entries for the current user. The shared part of each comes
+    from the fragment cache (all looked up at once) when we've rendered
+    that version of it before; only the subscription header, reply area
+    and relative times are rendered per request.
+    """
+    keys = [fragments.entry_key(entry) for entry in entries]
+    cached = fragments.get_fragments(keys)
+    rendered = {}
+    result = []
+    for entry, key in zip(entries, keys):
+        body = cached.get(key) or rendered.get(key)
+        if body is None:
+            body = rendered[key] = flask.render_template(
+                '_entry.jinja2', entry=entry,
+                subscription_slot=tasks.SUBSCRIPTION_SLOT,
+                reply_slot=tasks.REPLY_SLOT, time_slot=fragments.TIME_SLOT)
+
+        header = flask.render_template('_entry_subscription.jinja2',
+                                       subscription=entry.subscription)
+        reply = flask.render_template('_reply.jinja2', entry=entry)
+        body = body.replace(tasks.SUBSCRIPTION_SLOT, header)\
+                   .replace(tasks.REPLY_SLOT, reply)
+        result.append(fragments.fill_times(
+            body,
+            [c.published for c in entry.reply_context] + [entry.published],
+            relative_time))
+    fragments.set_fragments(rendered)
+    return result
+
+
 @views.app_template_global()
-def url_for_other_page(page):
+def url_for_other_page(**kwargs):
     """http://flask.pocoo.org/snippets/44/#URL+Generation+Helper
     """
     args = flask.request.view_args.copy()
     args.update(flask.request.args)
-    args['page'] = page
+    args.update(kwargs)
 
     return flask.url_for(flask.request.endpoint, **args)
 
 
-def dedupe_copies(entries):
+def dedupe_copies(entries, known_copies=()):
+    """Hide entries that are syndicated copies of other entries on the
+    page, and those whose permalinks are in known_copies (copies of
+    entries on other pages).
+    """
+    by_permalink = {}
+    for entry in entries:
+        if entry.permalink:
+            by_permalink.setdefault(entry.permalink, []).append(entry)
+
     all_copies = set()
     for entry in entries:
         syndurls = entry.get_property('syndication')
         if syndurls:
-            copies = [e for e in entries if e.permalink in syndurls]
+            copies = [e for url in set(syndurls)
+                      for e in by_permalink.get(url, ())]
             entry._syndicated_copies = copies
             all_copies.update(copies)
-    return [e for e in entries if e not in all_copies]
+    return [e for e in entries
+            if e not in all_copies and e.permalink not in known_copies]
 
 
 def font_awesome_class_for_service(service):
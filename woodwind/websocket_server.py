@@ -1,22 +1,25 @@
+from woodwind.notify_hub import NotifyHub
 import websockets
 import asyncio
-import asyncio_redis
+
+hub = NotifyHub()
 
 
 @asyncio.coroutine
 def handle_subscription(websocket, path):
     topic = yield from websocket.recv()
-    redis = yield from asyncio_redis.Connection.create()
-    ps = yield from redis.start_subscribe()
-    yield from ps.subscribe(['woodwind_notify:' + topic])
-    while True:
-        message = yield from ps.next_published()
-        if not websocket.open:
-            break
-        yield from websocket.send(message.value)
-    redis.close()
+    listener = yield from hub.subscribe(topic)
+    try:
+        while True:
+            message = yield from listener.get()
+            if message is None or not websocket.open:
+                break
+            yield from websocket.send(message)
+    finally:
+        yield from hub.unsubscribe(listener)
 
 
+asyncio.get_event_loop().run_until_complete(hub.start())
 asyncio.get_event_loop().run_until_complete(
     websockets.serve(handle_subscription, 'localhost', 8077))
 asyncio.get_event_loop().run_forever()